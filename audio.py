@@ -0,0 +1,253 @@
+from functools import lru_cache
+import math
+import queue
+import struct
+import subprocess
+import tempfile
+import threading
+import unittest
+import numpy
+
+
+# torch is imported by the functions that use it, probing and ffmpeg decoding only need numpy
+audio_decoders = ('ffmpeg', 'pydub')
+
+
+# Ratios with fewer phases (e.g. 48k -> 16k has one) are spread over several periods, so the
+# polyphase convolution has enough output channels to run as a matrix multiplication
+min_resample_phases = 16
+
+
+@lru_cache(maxsize=None)
+def get_resample_kernel(src_rate, dst_rate, lowpass_filter_width=6, rolloff=0.99):
+    # Polyphase bank of Hann windowed sinc filters, one phase per output sample of a period
+    import torch
+
+    gcd = math.gcd(src_rate, dst_rate)
+    orig_period = src_rate // gcd
+    new_period = dst_rate // gcd
+
+    periods_per_phase_bank = math.ceil(min_resample_phases / new_period)
+    orig_period *= periods_per_phase_bank
+    new_period *= periods_per_phase_bank
+
+    base_freq = min(orig_period, new_period) * rolloff
+    width = math.ceil(lowpass_filter_width * orig_period / base_freq)
+
+    idx = torch.arange(-width, width + orig_period, dtype=torch.float64)[None, None, :] / orig_period
+    t = torch.arange(0, -new_period, -1, dtype=torch.float64)[:, None, None] / new_period + idx
+    t *= base_freq
+    t = t.clamp(-lowpass_filter_width, lowpass_filter_width)
+
+    window = torch.cos(t * math.pi / lowpass_filter_width / 2) ** 2
+    t *= math.pi
+    kernels = torch.where(t == 0, torch.ones_like(t), t.sin() / t)
+    kernels *= window * base_freq / orig_period
+
+    return kernels.float(), width, orig_period, new_period
+
+
+def resample(waveform, src_rate, dst_rate, device='cpu', chunk_size=1 << 20, lowpass_filter_width=6, rolloff=0.99):
+    import torch
+
+    samples = waveform.flatten()
+    num_samples = samples.numel()
+
+    if src_rate == dst_rate:
+        return samples.to(device=device, dtype=torch.float32)
+
+    kernels, width, orig_period, new_period = get_resample_kernel(src_rate, dst_rate, lowpass_filter_width, rolloff)
+    kernels = kernels.to(device)
+
+    output_length = math.ceil(new_period * num_samples / orig_period)
+    output = torch.empty(output_length, dtype=torch.float32, device=device)
+
+    # Every period of orig_period input samples produces new_period output samples
+    num_periods = math.ceil(output_length / new_period)
+    chunk_periods = max(chunk_size // orig_period, 1)
+
+    for start_period in range(0, num_periods, chunk_periods):
+        end_period = min(start_period + chunk_periods, num_periods)
+
+        input_start = start_period * orig_period - width
+        input_end = end_period * orig_period + width
+        chunk = samples[max(input_start, 0):min(input_end, num_samples)].to(device=device, dtype=torch.float32)
+        chunk = torch.nn.functional.pad(chunk[None, None, :], [max(-input_start, 0), max(input_end - num_samples, 0)])
+
+        # (1, new_period, periods) interleaved into consecutive output samples
+        resampled = torch.nn.functional.conv1d(chunk, kernels, stride=orig_period)
+        resampled = resampled.transpose(1, 2).reshape(-1)
+
+        output_start = start_period * new_period
+        output_end = min(end_period * new_period, output_length)
+        output[output_start:output_end] = resampled[:output_end - output_start]
+
+    return output
+
+
+def probe_duration(file_path):
+    # Reads the duration from the container header without decoding, None if it is unknown
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', file_path]
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        return float(output)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def decode_audio_ffmpeg(file_path, sample_rate, duration=None, read_size=1 << 20):
+    # ffmpeg downmixes and resamples, 16 bit PCM is read straight into a preallocated buffer
+    if duration is None:
+        duration = probe_duration(file_path)
+
+    # One second of slack covers rounding of the container duration
+    capacity = int(((duration or 600) + 1) * sample_rate)
+    buffer = numpy.empty(capacity, dtype='<i2')
+    num_bytes = 0
+
+    command = [
+        'ffmpeg', '-nostdin', '-v', 'error',
+        '-i', file_path,
+        '-vn', '-ac', '1', '-ar', str(sample_rate),
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-',
+    ]
+    # stderr goes to a file, a pipe that is only read after stdout would block ffmpeg once it fills with errors
+    with tempfile.TemporaryFile() as error_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=error_file)
+        try:
+            while True:
+                if num_bytes == buffer.nbytes:
+                    grown_buffer = numpy.empty(buffer.size * 2, dtype=buffer.dtype)
+                    grown_buffer[:buffer.size] = buffer
+                    buffer = grown_buffer
+
+                view = memoryview(buffer).cast('B')[num_bytes:num_bytes + read_size]
+                bytes_read = process.stdout.readinto(view)
+                if not bytes_read:
+                    break
+                num_bytes += bytes_read
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+
+        if return_code != 0:
+            error_file.seek(0)
+            error_output = error_file.read().decode(errors='replace').strip()
+            raise RuntimeError(f'ffmpeg could not decode {file_path}: {error_output}')
+
+    return buffer[:num_bytes // buffer.itemsize]
+
+
+def decode_audio_pydub(file_path, format=None):
+    # Mono samples at the source sample rate, to be passed through resample
+    import torch
+    from pydub import AudioSegment
+
+    clip_audio = AudioSegment.from_file(file_path, format=format)
+    clip_audio = clip_audio.set_channels(1)
+    clip_samples = clip_audio.get_array_of_samples()
+    clip_audio_tensor = torch.from_numpy(numpy.frombuffer(clip_samples, dtype=clip_samples.typecode))
+
+    return clip_audio_tensor, clip_audio.frame_rate
+
+
+def write_wav(file_path, samples, sample_rate):
+    # Mono 16 bit PCM, the samples are written straight from the array without a copy
+    samples = numpy.ascontiguousarray(samples, dtype='<i2')
+    data_size = samples.nbytes
+    header = struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size,
+    )
+
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.write(memoryview(samples).cast('B'))
+
+    return len(header) + data_size
+
+
+class WavWriter:
+    # Writes WAV files on a background thread, so the caller does not wait on the filesystem for every segment.
+    # At most max_pending files are queued, the arrays must not change until close() returns
+    def __init__(self, max_pending=64):
+        self.files = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.bytes_written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.files.get()
+            if item is None:
+                break
+            # After an error the remaining files are only drained, close() raises it
+            if self.error is None:
+                try:
+                    self.bytes_written += write_wav(*item)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, file_path, samples, sample_rate):
+        if self.error is not None:
+            raise self.error
+        self.files.put((file_path, samples, sample_rate))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.files.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DecodeAudioFfmpegTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.rng = numpy.random.default_rng(0)
+
+    def temp_path(self, name):
+        return f'{self.temp_dir.name}/{name}'
+
+    def test_round_trip(self):
+        samples = self.rng.integers(-1 << 15, 1 << 15, 16000 * 3, dtype='<i2')
+        file_path = self.temp_path('clip.wav')
+        write_wav(file_path, samples, 16000)
+
+        numpy.testing.assert_array_equal(decode_audio_ffmpeg(file_path, 16000, duration=3), samples)
+        # A wrong duration only changes how the buffer grows
+        numpy.testing.assert_array_equal(decode_audio_ffmpeg(file_path, 16000, duration=0.1), samples)
+
+    def test_corrupt_input_raises(self):
+        file_path = self.temp_path('clip.wav')
+        with open(file_path, 'wb') as f:
+            f.write(self.rng.bytes(100000))
+
+        with self.assertRaisesRegex(RuntimeError, 'Invalid data'):
+            decode_audio_ffmpeg(file_path, 16000, duration=1)
+
+    def test_corrupt_frames_do_not_block(self):
+        # Every corrupt frame is logged, far more stderr than a pipe buffer holds
+        file_path = self.temp_path('clip.mp2')
+        command = ['ffmpeg', '-nostdin', '-v', 'error', '-f', 'lavfi', '-i', 'sine=d=60', '-c:a', 'mp2', file_path]
+        subprocess.run(command, check=True)
+        with open(file_path, 'rb') as f:
+            data = bytearray(f.read())
+        for i in self.rng.integers(1000, len(data), len(data) // 20):
+            data[i] = self.rng.integers(0, 256)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+
+        # ffmpeg skips the frames it cannot decode and exits cleanly
+        samples = decode_audio_ffmpeg(file_path, 16000, duration=60)
+        self.assertTrue(0 < len(samples) <= 61 * 16000)
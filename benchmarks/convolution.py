@@ -0,0 +1,50 @@
+from argparse import ArgumentParser
+import time
+import torch
+from subtitles_align import find_silence_points, convolution_engines
+from benchmarks.fixtures import synthetic_waveform
+
+
+def point_deviation(reference_points, points):
+    if len(reference_points) != len(points):
+        return None
+
+    return max((abs(a - b) for a, b in zip(reference_points, points)), default=0)
+
+
+def format_deviation(deviation):
+    return 'count mismatch' if deviation is None else f'{deviation} samples'
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--duration', help='Duration of the synthetic clip in seconds', type=float, default=60)
+    parser.add_argument('--kernel-sizes', help='Comma separated Gaussian kernel sizes', type=str, default='8193')
+    parser.add_argument('--threads', help='Number of torch intra-op threads', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--noise', help='Background noise amplitude, 0 leaves digital silence between the bursts', type=float, default=30)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    sample_rate = 16000
+    waveform = synthetic_waveform(args.duration, sample_rate=sample_rate, noise=args.noise)
+
+    for kernel_size in [int(x) for x in args.kernel_sizes.split(',')]:
+        timings = {}
+        min_points = {}
+        edges = {}
+        for engine in convolution_engines:
+            start_time = time.perf_counter()
+            for _ in range(args.repeat):
+                min_points[engine], edges[engine] = find_silence_points(waveform, sample_rate, 'cpu', kernel_size=kernel_size, engine=engine)
+            timings[engine] = (time.perf_counter() - start_time) / args.repeat
+
+        for engine in convolution_engines:
+            print(
+                f'kernel={kernel_size} engine={engine:<6} '
+                f'time={timings[engine]:.3f}s '
+                f'speedup={timings["direct"] / timings[engine]:.1f}x '
+                f'edges={len(edges[engine])} '
+                f'max_edge_deviation={format_deviation(point_deviation(edges["direct"], edges[engine]))} '
+                f'max_min_point_deviation={format_deviation(point_deviation(min_points["direct"], min_points[engine]))}'
+            )
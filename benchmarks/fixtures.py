@@ -0,0 +1,115 @@
+import os
+import wave
+import numpy
+import torch
+
+
+# Cue vocabularies also exercise the normalizer: bracketed remarks, entities, digits and punctuation
+fixture_words = {
+    'en': ['the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', "don't", 'we', 'said', 'hello', 'again'],
+    'iw': ['שלום', 'מה', 'שלומך', 'אני', 'הולך', 'הביתה', 'עכשיו', 'תודה', 'רבה', 'כן', 'לא', 'אולי', 'מחר'],
+}
+fixture_decorations = ['', '', '', '(laughs) ', '[music] ', '&quot;', '<i>', 'Hey, ', '- ']
+
+
+# Speech-like noise bursts separated by silences, returned with the (start, end) sample positions of the bursts
+def synthetic_clip(duration, sample_rate=16000, seed=0, min_burst=0.25, max_burst=3.0, min_gap=0.1, max_gap=2.0, amplitude=4000, noise=30):
+    generator = torch.Generator().manual_seed(seed)
+    num_samples = int(duration * sample_rate)
+    waveform = torch.zeros(num_samples)
+    bursts = []
+
+    position = 0
+    while position < num_samples:
+        burst = int(torch.empty(1).uniform_(min_burst, max_burst, generator=generator).item() * sample_rate)
+        gap = int(torch.empty(1).uniform_(min_gap, max_gap, generator=generator).item() * sample_rate)
+        burst = min(burst, num_samples - position)
+        waveform[position:position + burst] = torch.randn(burst, generator=generator) * amplitude
+        bursts.append((position, position + burst))
+        position += burst + gap
+
+    waveform += torch.randn(num_samples, generator=generator) * noise
+    waveform = waveform.round().clamp(-(1 << 15), (1 << 15) - 1)
+
+    return waveform[None, None, :], bursts
+
+
+# As synthetic_clip, an int16 valued float tensor of shape (1, 1, N)
+def synthetic_waveform(duration, sample_rate=16000, seed=0, **kwargs):
+    return synthetic_clip(duration, sample_rate=sample_rate, seed=seed, **kwargs)[0]
+
+
+# One cue per burst, with the cue times jittered so they have to be snapped back to the silences
+def synthetic_cues(bursts, sample_rate, language='en', seed=0, max_jitter_ms=300):
+    rng = numpy.random.default_rng(seed)
+    words = fixture_words[language]
+    cues = []
+
+    for start, end in bursts:
+        start_ms = max(round(start * 1000 / sample_rate) + int(rng.integers(-max_jitter_ms, max_jitter_ms + 1)), 0)
+        end_ms = max(round(end * 1000 / sample_rate) + int(rng.integers(-max_jitter_ms, max_jitter_ms + 1)), start_ms + 1)
+
+        num_words = max(int((end - start) / sample_rate * 2.5), 1)
+        cues.append((start_ms, end_ms, synthetic_text(rng, words, num_words)))
+
+    return cues
+
+
+def synthetic_text(rng, words, num_words, number_probability=0.2):
+    text = ' '.join(rng.choice(words, size=num_words))
+    text = str(rng.choice(fixture_decorations)) + text
+    if rng.random() < number_probability:
+        text += f' {int(rng.integers(0, 3000))}'
+    if rng.random() < 0.3:
+        text = text.replace(' ', '\n', 1)
+    return text
+
+
+# Subtitle like lines for the text normalization benchmarks
+def synthetic_lines(num_lines, language='en', seed=0, number_probability=0.2):
+    rng = numpy.random.default_rng(seed)
+    words = fixture_words[language]
+    return [synthetic_text(rng, words, int(rng.integers(1, 12)), number_probability) for _ in range(num_lines)]
+
+
+def format_srt_time(ms):
+    return f'{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}'
+
+
+def write_srt(path, cues):
+    with open(path, 'w', encoding='utf-8') as f:
+        for index, (start_ms, end_ms, text) in enumerate(cues, start=1):
+            f.write(f'{index}\n{format_srt_time(start_ms)} --> {format_srt_time(end_ms)}\n{text}\n\n')
+
+
+def write_fixture_wav(path, waveform, sample_rate):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(waveform.flatten().numpy().astype('<i2').tobytes())
+
+
+# A clip directory laid out like the scraped data: <dir>/<name>/clip.wav and clip.<language>.srt
+def create_fixture(directory, name, duration, sample_rate, language='en', seed=0):
+    waveform, bursts = synthetic_clip(duration, sample_rate=sample_rate, seed=seed)
+    cues = synthetic_cues(bursts, sample_rate, language=language, seed=seed)
+
+    clip_dir = os.path.join(directory, name)
+    os.makedirs(clip_dir, exist_ok=True)
+    clip_path = os.path.join(clip_dir, 'clip.wav')
+    srt_path = os.path.join(clip_dir, f'clip.{language}.srt')
+    write_fixture_wav(clip_path, waveform, sample_rate)
+    write_srt(srt_path, cues)
+
+    return {
+        'name': name,
+        'clip_path': clip_path,
+        'srt_path': srt_path,
+        'duration': duration,
+        'sample_rate': sample_rate,
+        'language': language,
+        'waveform': waveform,
+        'bursts': bursts,
+        'cues': cues,
+    }
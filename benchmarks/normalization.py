@@ -0,0 +1,68 @@
+from argparse import ArgumentParser
+import re
+import time
+from languages import languages
+from utils import filter_sub_text
+from benchmarks.fixtures import synthetic_lines
+
+
+def legacy_filter_text(text, language):
+    # Language.filter_text as it was, with the patterns and translation table built on every call
+    if language.name == 'en':
+        return re.sub(r"[^a-zA-Z' 0-9]", '', text)
+
+    result = text
+    numeric_chars = r'\.?0-9\\\/\-'
+    alphabet = 'אבגדהוזחטיכךלמםנןסעפףצץקרשת'
+    result = re.sub(rf"[^{numeric_chars},' {alphabet}]", '', result)
+    result = language.number_transformer.transform_text(result)
+    result = re.sub(rf'[{numeric_chars}]', '', result)
+    trans = str.maketrans(
+        'ךםןףץ',
+        'כמנפצ',
+    )
+    result = result.translate(trans)
+    return result
+
+
+def legacy_filter_sub_text(text, language):
+    result = text
+    result = result.lower()
+    result = re.sub(r'&[^&\;]{2,8}\;', '', result)
+    result = re.sub(r'\(' + r'[^\)]+' r'\)', '', result)
+    result = re.sub(r'\[' + r'[^\]]+' r'\]', '', result)
+    result = re.sub(r'\{' + r'[^\}]+' r'\}', '', result)
+    result = re.sub(r'\<' + r'[^\>]+' r'\}', '', result)
+    result = re.sub(r'\s+', ' ', result)
+    result = legacy_filter_text(result, language)
+    result = re.sub(r'\s+', ' ', result)
+    result = result.strip()
+
+    if result == '':
+        return None
+
+    return result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--lines', help='Number of synthetic subtitle lines per language', type=int, default=200000)
+    parser.add_argument('--number-probability', help='Fraction of lines that contain a number', type=float, default=0.2)
+    args = parser.parse_args()
+
+    normalizers = {
+        'legacy': legacy_filter_sub_text,
+        'compiled': filter_sub_text,
+    }
+
+    for language_code, language in languages.items():
+        lines = synthetic_lines(args.lines, language=language_code, number_probability=args.number_probability)
+        outputs = {}
+
+        for name, normalizer in normalizers.items():
+            start_time = time.perf_counter()
+            outputs[name] = [normalizer(line, language) for line in lines]
+            elapsed = time.perf_counter() - start_time
+            print(f'{language_code} {name:<9} {len(lines) / elapsed:10.0f} lines/s')
+
+        print(f'{language_code} equal={outputs["legacy"] == outputs["compiled"]}')
@@ -0,0 +1,58 @@
+from argparse import ArgumentParser
+import time
+import numpy
+from languages.iw import NumberTransformer
+from benchmarks.fixtures import fixture_words
+
+
+class ParsingNumberTransformer(NumberTransformer):
+    # Parses every number, as without the lookup table and cache
+    def number_label(self, whole, decimal=None):
+        return self.parse_number_label(whole, decimal)
+
+
+def synthetic_number(rng):
+    kind = rng.integers(0, 6)
+    if kind == 0:
+        return f'{rng.integers(1900, 2031)}'
+    if kind == 1:
+        return f'{rng.integers(0, 101)}%'
+    if kind == 2:
+        return f'{rng.integers(0, 13)}'
+    if kind == 3:
+        return f'{rng.integers(0, 1000)}.{rng.choice([5, 25, 75, 1, 99])}'
+    if kind == 4:
+        return f'{rng.integers(0, 100000):,}₪'
+    return f'{rng.integers(0, 10 ** 9)}'
+
+
+# Hebrew lines with several numbers each, years, percentages, counts, decimals, prices and long numbers
+def number_dense_lines(num_lines, seed=0, numbers_per_line=3):
+    rng = numpy.random.default_rng(seed)
+    words = fixture_words['iw']
+    return [
+        ' '.join(f'{rng.choice(words)} {synthetic_number(rng)}' for _ in range(numbers_per_line))
+        for _ in range(num_lines)
+    ]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--lines', help='Number of synthetic lines', type=int, default=100000)
+    parser.add_argument('--numbers-per-line', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = number_dense_lines(args.lines, numbers_per_line=args.numbers_per_line)
+    transformers = {
+        'parsing': ParsingNumberTransformer(),
+        'cached': NumberTransformer(),
+    }
+
+    outputs = {}
+    for name, transformer in transformers.items():
+        start_time = time.perf_counter()
+        outputs[name] = [transformer.transform_text(line) for line in lines]
+        elapsed = time.perf_counter() - start_time
+        print(f'{name:<8} {len(lines) * args.numbers_per_line / elapsed:10.0f} numbers/s')
+
+    print(f'equal={outputs["parsing"] == outputs["cached"]}')
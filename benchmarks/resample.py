@@ -0,0 +1,51 @@
+from argparse import ArgumentParser
+import math
+import time
+import torch
+from audio import resample
+from benchmarks.fixtures import synthetic_waveform
+
+
+def interpolate_resample(waveform, src_rate, dst_rate):
+    # The previous prepare_manifest path: float copy of the clip and nearest neighbour interpolation
+    clip_audio_tensor = torch.tensor(waveform.flatten().tolist(), dtype=torch.float32)[None, None, :]
+    return torch.nn.functional.interpolate(clip_audio_tensor, scale_factor=dst_rate / src_rate, recompute_scale_factor=False)[0, 0]
+
+
+def alias_level(resampler, src_rate, dst_rate, frequency, duration=1.0):
+    # Energy left after resampling a tone above the target Nyquist frequency, in dB relative to the input
+    t = torch.arange(int(src_rate * duration), dtype=torch.float64) / src_rate
+    tone = (torch.sin(2 * math.pi * frequency * t) * 10000).float()
+    output = resampler(tone, src_rate, dst_rate)
+    return 10 * math.log10(output.pow(2).mean().item() / tone.pow(2).mean().item() + 1e-20)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--duration', help='Duration of the synthetic clip in seconds', type=float, default=600)
+    parser.add_argument('--sample-rates', help='Comma separated source sample rates', type=str, default='44100,48000')
+    parser.add_argument('--target-sample-rate', type=int, default=16000)
+    parser.add_argument('--threads', help='Number of torch intra-op threads', type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    resamplers = {
+        'interpolate': interpolate_resample,
+        'sinc': resample,
+    }
+
+    for src_rate in [int(x) for x in args.sample_rates.split(',')]:
+        waveform = synthetic_waveform(args.duration, sample_rate=src_rate)
+        alias_frequency = 0.7 * src_rate / 2
+
+        for name, resampler in resamplers.items():
+            start_time = time.perf_counter()
+            resampler(waveform, src_rate, args.target_sample_rate)
+            elapsed = time.perf_counter() - start_time
+
+            print(
+                f'{src_rate} -> {args.target_sample_rate} {name:<11} '
+                f'time={elapsed:.3f}s '
+                f'throughput={args.duration / elapsed / args.threads:.0f}x realtime per thread '
+                f'alias_level@{alias_frequency:.0f}Hz={alias_level(resampler, src_rate, args.target_sample_rate, alias_frequency):.1f}dB'
+            )
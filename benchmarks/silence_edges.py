@@ -0,0 +1,63 @@
+from argparse import ArgumentParser
+import time
+import torch
+from subtitles_align import smooth_silence_envelope, find_silence_edges
+from benchmarks.fixtures import synthetic_waveform
+
+
+def legacy_silence_edges(conv, threshold=0.020):
+    # Edge pairing as find_silence_points did it before: Python loop with an argmin (and a device sync) per silence
+    filter = (conv < threshold).long()
+
+    padding = torch.tensor([0], dtype=torch.long, device=conv.device)
+    filter_positive = filter == 1
+    filter_negative = torch.cat([filter[1:], padding]) != 1
+
+    falling_edges_indexes = (filter_positive & filter_negative).nonzero().flatten().tolist()
+    raising_edges_indexes = (~filter_positive & ~filter_negative).nonzero().flatten().tolist()
+
+    if (falling_edges_indexes + [float('inf')])[0] < (raising_edges_indexes + [float('inf')])[0]:
+        raising_edges_indexes.insert(0, 0)
+
+    silence_edges = torch.zeros(conv.shape)
+    silence_min_points = []
+    silence_edge_points = []
+    for r, f in zip(raising_edges_indexes, falling_edges_indexes):
+        silence_min_points.append((r + conv[r:f].argmin()).item())
+        silence_edges[r] = 1
+        silence_edge_points.append(r)
+        silence_edges[f] = 1
+        silence_edge_points.append(f)
+
+    return silence_min_points, silence_edge_points
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--durations', help='Comma separated durations of the synthetic clips in seconds', type=str, default='600,3600')
+    parser.add_argument('--kernel-size', help='A small kernel keeps short gaps as separate silences', type=int, default=129)
+    parser.add_argument('--threads', help='Number of torch intra-op threads', type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    sample_rate = 16000
+
+    for duration in [float(x) for x in args.durations.split(',')]:
+        waveform = synthetic_waveform(duration, sample_rate=sample_rate, min_burst=0.05, max_burst=0.3, min_gap=0.05, max_gap=0.3)
+        envelope = list(smooth_silence_envelope(waveform, 'cpu', kernel_size=args.kernel_size))
+        conv = torch.cat([c for _, c in envelope])
+
+        start_time = time.perf_counter()
+        legacy_min_points, legacy_edge_points = legacy_silence_edges(conv)
+        legacy_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        min_points, edge_points = find_silence_edges(envelope, conv.numel())
+        vectorized_time = time.perf_counter() - start_time
+
+        print(
+            f'duration={duration:.0f}s silences={len(edge_points) // 2} '
+            f'legacy={legacy_time:.3f}s vectorized={vectorized_time:.3f}s '
+            f'speedup={legacy_time / vectorized_time:.1f}x '
+            f'equal={legacy_edge_points == edge_points.tolist() and legacy_min_points == min_points.tolist()}'
+        )
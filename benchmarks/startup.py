@@ -0,0 +1,39 @@
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+import time
+import multiprocessing
+from prepare_manifest import ManifestConfig, init_worker
+
+
+def get_pid(_):
+    return os.getpid()
+
+
+def import_time(module):
+    # In a fresh interpreter, so nothing is already imported
+    code = f'import time; start_time = time.perf_counter(); import {module}; print(time.perf_counter() - start_time)'
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], stdout=subprocess.PIPE, check=True).stdout
+    return float(output)
+
+
+def pool_startup_time(num_workers):
+    # Until every worker is spawned, imported and initialized and has run a task
+    start_time = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(num_workers, initializer=init_worker, initargs=(ManifestConfig(), 1)) as pool:
+        pool.map(get_pid, range(num_workers), chunksize=1)
+        return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--workers', help='Comma separated pool sizes', type=str, default='1,2,4')
+    parser.add_argument('--repeat', help='Runs per measurement, the best time is reported', type=int, default=3)
+    args = parser.parse_args()
+
+    for module in ['prepare_manifest', 'subtitles_align', 'torch']:
+        print(f'import {module:<20} {min(import_time(module) for _ in range(args.repeat)):.3f}s')
+
+    for num_workers in [int(x) for x in args.workers.split(',')]:
+        print(f'pool of {num_workers} workers ready in {min(pool_startup_time(num_workers) for _ in range(args.repeat)):.3f}s')
@@ -0,0 +1,198 @@
+from argparse import ArgumentParser
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy
+import torch
+from audio import resample, decode_audio_ffmpeg
+from languages import languages
+from subtitles_align import find_silence_points, align_times_by_silences
+from utils import filter_sub_text
+from prepare_manifest import ManifestConfig, segment_subtitles, prepare_clip
+from benchmarks.fixtures import create_fixture
+
+
+# duration:sample_rate:language, covering the common source rates and both languages
+default_fixtures = '60:16000:en,600:44100:iw,600:48000:en'
+target_sample_rate = 16000
+min_known_gap = 0.5
+min_normalization_lines = 20000
+
+
+def get_git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.strip() != b''
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def digest(*values):
+    h = hashlib.sha256()
+    for value in values:
+        h.update(numpy.ascontiguousarray(value).tobytes() if isinstance(value, numpy.ndarray) else json.dumps(value, ensure_ascii=False).encode())
+    return h.hexdigest()[:16]
+
+
+def prepare_clip_digest(clip_manifest_items, out_path):
+    # Paths relative to the output directory, with every file left under it and the bytes of the segments.
+    # The clip manifest and cache key hold the temporary and fixture paths, so only their names are kept
+    items = [{**item, 'audio_filepath': os.path.relpath(item['audio_filepath'], out_path)} for item in clip_manifest_items]
+    segment_files = []
+    for dir_path, _, file_names in sorted(os.walk(out_path)):
+        for file_name in sorted(file_names):
+            path = os.path.join(dir_path, file_name)
+            file_digest = None
+            if file_name.endswith('.wav'):
+                with open(path, 'rb') as f:
+                    file_digest = hashlib.sha256(f.read()).hexdigest()
+            segment_files.append([os.path.relpath(path, out_path), file_digest])
+    return digest(items, segment_files)
+
+
+def timed(function, repeat):
+    # Best of repeat runs, the result of the last one
+    best_time = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time, result
+
+
+def run_fixture(fixture, repeat):
+    sample_rate = fixture['sample_rate']
+    language = languages[fixture['language']]
+    results = {}
+
+    def record(stage, elapsed, output_digest=None, **values):
+        results[stage] = {
+            'seconds': elapsed,
+            'audio_seconds_per_second': fixture['duration'] / elapsed if elapsed > 0 else None,
+            'digest': output_digest,
+            **values,
+        }
+
+    # Decoding depends on the local ffmpeg build, so it is timed but kept out of the later stages
+    if shutil.which('ffmpeg') is not None:
+        elapsed, decoded = timed(lambda: decode_audio_ffmpeg(fixture['clip_path'], target_sample_rate, fixture['duration']), repeat)
+        record('decode', elapsed, samples=int(decoded.size))
+
+    elapsed, waveform = timed(lambda: resample(fixture['waveform'], sample_rate, target_sample_rate).round(), repeat)
+    record('resample', elapsed, digest(waveform.numpy()), samples=waveform.numel())
+
+    elapsed, (silence_min_points, silence_edge_points) = timed(lambda: find_silence_points(waveform[None, None, :], target_sample_rate, 'cpu'), repeat)
+
+    # A known gap is found when a detected silence minimum falls inside it
+    gaps = [(end * target_sample_rate // sample_rate, next_start * target_sample_rate // sample_rate) for (_, end), (next_start, _) in zip(fixture['bursts'], fixture['bursts'][1:])]
+    gaps = numpy.array([gap for gap in gaps if gap[1] - gap[0] >= min_known_gap * target_sample_rate], dtype=numpy.int64).reshape(-1, 2)
+    found = numpy.searchsorted(silence_min_points, gaps[:, 1]) > numpy.searchsorted(silence_min_points, gaps[:, 0])
+    record('silence_detection', elapsed, digest(silence_min_points, silence_edge_points), silences=len(silence_min_points), known_gap_recall=float(found.mean()) if len(gaps) > 0 else None)
+
+    start_times = numpy.array([cue[0] for cue in fixture['cues']], dtype=numpy.int64)
+    end_times = numpy.array([cue[1] for cue in fixture['cues']], dtype=numpy.int64)
+    elapsed, (aligned_start_times, aligned_end_times) = timed(lambda: align_times_by_silences(start_times, end_times, silence_edge_points, target_sample_rate), repeat)
+
+    true_times = numpy.array(fixture['bursts'], dtype=numpy.int64) * 1000 // sample_rate
+    record(
+        'alignment', elapsed, digest(aligned_start_times, aligned_end_times),
+        cues=len(start_times),
+        mean_error_ms_before=float(numpy.abs(numpy.stack([start_times, end_times], axis=1) - true_times).mean()),
+        mean_error_ms_after=float(numpy.abs(numpy.stack([aligned_start_times, aligned_end_times], axis=1) - true_times).mean()),
+    )
+
+    # Cue texts repeated to a corpus sized batch, a single clip is too few lines to time
+    texts = [cue[2] for cue in fixture['cues']]
+    texts = texts * max(min_normalization_lines // len(texts), 1)
+    elapsed, normalized = timed(lambda: [filter_sub_text(text, language) for text in texts], repeat)
+    record('normalization', elapsed, digest(normalized), lines=len(texts), lines_per_second=len(texts) / elapsed if elapsed > 0 else None)
+
+    # Short fixtures would be truncated away entirely with the default 20 seconds at each end
+    config = ManifestConfig(language_code=fixture['language'], audio_truncate={'start': 1000, 'end': 1000})
+    clip_duration_ms = int(fixture['duration'] * 1000)
+    sub_texts = [cue[2] for cue in fixture['cues']]
+    elapsed, segments = timed(lambda: segment_subtitles(sub_texts, aligned_start_times.tolist(), aligned_end_times.tolist(), clip_duration_ms, config), repeat)
+    record('segmentation', elapsed, digest(segments), segments=len(segments))
+
+    # The whole clip through decoding, alignment, segmentation and the segment writes and rename,
+    # each run into a fresh output directory so none of them is a cache hit
+    if shutil.which('ffmpeg') is not None:
+        def prepare_fixture_clip():
+            with tempfile.TemporaryDirectory() as out_path:
+                clip_config = ManifestConfig(language_code=fixture['language'], out_path=out_path, audio_truncate=config.audio_truncate)
+                clip_manifest_items = prepare_clip(fixture['clip_path'], fixture['srt_path'], clip_config, duration=fixture['duration'])
+                return len(clip_manifest_items), prepare_clip_digest(clip_manifest_items, out_path)
+
+        elapsed, (num_segments, output_digest) = timed(prepare_fixture_clip, repeat)
+        record('prepare_clip', elapsed, output_digest, segments=num_segments)
+
+    return results
+
+
+def compare_results(results, baseline):
+    # Speed ratios against the baseline and outputs that are no longer identical
+    changed = []
+    for name, stages in results['fixtures'].items():
+        for stage, result in stages.items():
+            baseline_result = baseline['fixtures'].get(name, {}).get(stage)
+            if baseline_result is None:
+                continue
+            speedup = baseline_result['seconds'] / result['seconds'] if result['seconds'] > 0 else float('inf')
+            same_output = result['digest'] == baseline_result['digest']
+            print(f'{name:<20} {stage:<18} {baseline_result["seconds"]:9.3f}s -> {result["seconds"]:9.3f}s {speedup:6.2f}x {"" if same_output else "OUTPUT CHANGED"}')
+            if not same_output:
+                changed.append((name, stage))
+    return changed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--fixtures', help='Comma separated duration:sample_rate:language fixture specs', type=str, default=default_fixtures)
+    parser.add_argument('--fixtures-dir', help='Keep the generated clips and subtitles here instead of a temporary directory', type=str, default=None)
+    parser.add_argument('--repeat', help='Runs per stage, the best time is reported', type=int, default=3)
+    parser.add_argument('--threads', help='Number of torch intra-op threads', type=int, default=1)
+    parser.add_argument('--output', help='Results JSON file', type=str, default='bench_results.json')
+    parser.add_argument('--compare', help='Results JSON file of a previous run to compare against', type=str, default=None)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    results = {
+        'commit': get_git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'threads': args.threads,
+        'repeat': args.repeat,
+        'fixtures': {},
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fixtures_dir = args.fixtures_dir or temp_dir
+        for seed, spec in enumerate(args.fixtures.split(',')):
+            duration, sample_rate, language = spec.split(':')
+            name = f'{language}_{duration}s_{sample_rate}'
+            fixture = create_fixture(fixtures_dir, name, float(duration), int(sample_rate), language=language, seed=seed)
+            results['fixtures'][name] = run_fixture(fixture, args.repeat)
+
+            for stage, result in results['fixtures'][name].items():
+                print(f'{name:<20} {stage:<18} {result["seconds"]:9.3f}s {result["audio_seconds_per_second"]:10.0f} audio s/s')
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        changed = compare_results(results, baseline)
+        if len(changed) > 0:
+            sys.exit(1)
@@ -0,0 +1,341 @@
+from argparse import ArgumentParser
+from itertools import compress
+import hashlib
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+import numpy
+from tqdm import tqdm
+from languages import languages
+from utils import filter_sub_text, imap_ordered, read_line_chunks, split_chunk_lines
+
+
+# Why a line is dropped, kept in the low 2 bits of the dropped line numbers
+near_duplicate, exact_duplicate, rejected = 1, 2, 3
+
+# Exact keys have the low bit cleared and MinHash band keys set, so a dropped line's key tells which it was
+band_key_bit = numpy.uint64(1)
+
+# A prime above the 32 bit shingle hashes, the MinHash permutations are (a * x + b) % minhash_prime
+minhash_prime = numpy.uint64((1 << 32) + 15)
+# Lines per MinHash batch, bounds the (permutations, shingles) matrix
+minhash_batch_size = 4096
+
+worker_state = {}
+
+
+def exact_keys(texts):
+    digests = b''.join(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest() for text in texts)
+    return numpy.frombuffer(digests, dtype='<u8') & ~band_key_bit
+
+
+def minhash_permutations(num_perm, seed=0):
+    # The same in every worker, so signatures of lines in different chunks are comparable
+    rng = numpy.random.default_rng(seed)
+    a = rng.integers(1, 1 << 31, size=num_perm, dtype=numpy.uint64)
+    b = rng.integers(0, 1 << 32, size=num_perm, dtype=numpy.uint64)
+    return a, b
+
+
+def minhash_signatures(texts, permutations, shingle_size):
+    # (lines, permutations) minimums of the permuted hashes of each line's word shingles,
+    # a line shorter than a shingle is one shingle
+    a, b = permutations
+    signatures = numpy.empty((len(texts), len(a)), dtype=numpy.uint64)
+
+    for batch_start in range(0, len(texts), minhash_batch_size):
+        shingle_hashes = []
+        shingle_counts = []
+        for text in texts[batch_start:batch_start + minhash_batch_size]:
+            words = text.split(' ')
+            shingles = [' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))]
+            shingle_hashes.extend(zlib.crc32(shingle.encode('utf-8')) for shingle in shingles)
+            shingle_counts.append(len(shingles))
+
+        x = numpy.array(shingle_hashes, dtype=numpy.uint64)
+        permuted = (a[:, None] * x[None, :] + b[:, None]) % minhash_prime
+        starts = numpy.cumsum([0] + shingle_counts[:-1])
+        signatures[batch_start:batch_start + len(shingle_counts)] = numpy.minimum.reduceat(permuted, starts, axis=1).T
+
+    return signatures
+
+
+def band_keys(signatures, bands):
+    # (lines, bands) keys of the signature rows of each band, lines sharing a key are near duplicates
+    rows = signatures.shape[1] // bands
+    banded = signatures[:, :bands * rows].reshape(len(signatures), bands, rows)
+
+    keys = numpy.broadcast_to(numpy.arange(1, bands + 1, dtype=numpy.uint64) * numpy.uint64(0x9E3779B97F4A7C15), banded.shape[:2]).copy()
+    for row in range(rows):
+        keys ^= banded[:, :, row]
+        keys *= numpy.uint64(0xBF58476D1CE4E5B9)
+        keys ^= keys >> numpy.uint64(31)
+
+    return keys | band_key_bit
+
+
+def init_worker(language_code, num_perm=None, bands=None, shingle_size=None):
+    worker_state['language'] = languages[language_code]
+    worker_state['permutations'] = minhash_permutations(num_perm) if num_perm is not None else None
+    worker_state['bands'] = bands
+    worker_state['shingle_size'] = shingle_size
+
+
+def hash_chunk(chunk_and_size):
+    # Returns the chunk's line and byte counts, its keys with the chunk line of each,
+    # and the chunk lines rejected by the normalization
+    chunk, num_bytes = chunk_and_size
+    language = worker_state['language']
+
+    lines = split_chunk_lines(chunk.decode('utf-8'))
+    texts = [filter_sub_text(line, language) for line in lines]
+    line_numbers = [i for i, text in enumerate(texts) if text is not None]
+    texts = [texts[i] for i in line_numbers]
+    line_numbers = numpy.array(line_numbers, dtype=numpy.uint64)
+
+    keys = [exact_keys(texts)]
+    key_lines = [line_numbers]
+    if worker_state['permutations'] is not None and len(texts) > 0:
+        signatures = minhash_signatures(texts, worker_state['permutations'], worker_state['shingle_size'])
+        keys.append(band_keys(signatures, worker_state['bands']).ravel())
+        key_lines.append(numpy.repeat(line_numbers, worker_state['bands']))
+
+    rejected_lines = numpy.setdiff1d(numpy.arange(len(lines), dtype=numpy.uint64), line_numbers)
+
+    return len(lines), num_bytes, numpy.concatenate(keys), numpy.concatenate(key_lines), rejected_lines
+
+
+class DuplicateFinder:
+    # Keeps the first line of every key as a sorted set of (key, line) in memory, past memory_budget bytes the set
+    # is spilled to a run on disk and the runs are merged one key range at a time in finish. Every line holding a key
+    # first seen on an earlier line is dropped, the dropped lines are appended to dropped.bin with their kind
+    def __init__(self, tmp_path, memory_budget):
+        self.tmp_path = tmp_path
+        self.memory_budget = memory_budget
+        self.keys = []
+        self.lines = []
+        self.num_buffered = 0
+        self.num_compacted = 0
+        self.runs = []
+        self.dropped_path = os.path.join(tmp_path, 'dropped.bin')
+        self.dropped_file = open(self.dropped_path, 'wb')
+
+    def add(self, keys, lines):
+        self.keys.append(keys)
+        self.lines.append(lines)
+        self.num_buffered += len(keys)
+
+        # Compacted when the new entries alone fill the budget, spilled when the compacted set still fills half
+        if (self.num_buffered - self.num_compacted) * 16 > self.memory_budget / 2:
+            self.compact()
+            if self.num_buffered * 16 > self.memory_budget / 2:
+                self.spill()
+
+    def drop(self, lines, kind):
+        self.dropped_file.write(((lines << numpy.uint64(2)) | numpy.uint64(kind)).astype('<u8').tobytes())
+
+    def deduplicate(self, keys, lines):
+        # Sorted by key then line, the first line of each key stays and the others are dropped
+        order = numpy.lexsort((lines, keys))
+        keys, lines = keys[order], lines[order]
+        is_first = numpy.ones(len(keys), dtype=bool)
+        is_first[1:] = keys[1:] != keys[:-1]
+
+        dropped_keys, dropped_lines = keys[~is_first], lines[~is_first]
+        is_band_key = (dropped_keys & band_key_bit) != 0
+        self.drop(dropped_lines[is_band_key], near_duplicate)
+        self.drop(dropped_lines[~is_band_key], exact_duplicate)
+
+        return keys[is_first], lines[is_first]
+
+    def compact(self):
+        keys, lines = self.deduplicate(numpy.concatenate(self.keys), numpy.concatenate(self.lines))
+        self.keys, self.lines = [keys], [lines]
+        self.num_buffered = self.num_compacted = len(keys)
+
+    def spill(self):
+        run_path = os.path.join(self.tmp_path, f'run-{len(self.runs)}')
+        numpy.save(f'{run_path}.keys.npy', self.keys[0])
+        numpy.save(f'{run_path}.lines.npy', self.lines[0])
+        self.runs.append(run_path)
+        self.keys, self.lines = [], []
+        self.num_buffered = self.num_compacted = 0
+
+    def finish(self):
+        # Returns the path of the dropped lines
+        if self.num_buffered > 0:
+            self.compact()
+
+        if len(self.runs) > 0:
+            if self.num_buffered > 0:
+                self.spill()
+
+            runs = [
+                (numpy.load(f'{run_path}.keys.npy', mmap_mode='r'), numpy.load(f'{run_path}.lines.npy', mmap_mode='r'))
+                for run_path in self.runs
+            ]
+            # Keys are uniformly distributed, so equal ranges of them hold about the same number of entries
+            num_entries = sum(len(keys) for keys, _ in runs)
+            num_ranges = max(math.ceil(num_entries * 16 * 4 / self.memory_budget), 1)
+            bounds = [numpy.uint64(i * (1 << 64) // num_ranges) for i in range(num_ranges)] + [None]
+
+            for low, high in zip(bounds, bounds[1:]):
+                range_keys, range_lines = [], []
+                for keys, lines in runs:
+                    start = numpy.searchsorted(keys, low)
+                    end = numpy.searchsorted(keys, high) if high is not None else len(keys)
+                    range_keys.append(keys[start:end])
+                    range_lines.append(lines[start:end])
+                self.deduplicate(numpy.concatenate(range_keys), numpy.concatenate(range_lines))
+
+        self.dropped_file.close()
+        return self.dropped_path
+
+
+def load_drop_kinds(dropped_path, kinds_path, num_lines, slice_size=1 << 24):
+    # Per line 0 when it is kept, else why it is dropped, as a memory mapped file. A line dropped for several
+    # reasons gets the largest kind, exact duplicates are reported as such rather than as near duplicates
+    if num_lines == 0:
+        return numpy.zeros(0, dtype=numpy.uint8)
+
+    drop_kinds = numpy.memmap(kinds_path, dtype=numpy.uint8, mode='w+', shape=(num_lines,))
+    if os.path.getsize(dropped_path) > 0:
+        dropped = numpy.memmap(dropped_path, dtype='<u8', mode='r')
+        for kind in [near_duplicate, exact_duplicate, rejected]:
+            for start in range(0, len(dropped), slice_size):
+                dropped_slice = dropped[start:start + slice_size]
+                dropped_slice = dropped_slice[(dropped_slice & numpy.uint64(3)) == kind]
+                drop_kinds[dropped_slice >> numpy.uint64(2)] = kind
+
+    return drop_kinds
+
+
+def write_kept_lines(input_path, output_path, chunk_size, drop_kinds, limit=None):
+    # Reads the input again in the same chunks, writing the lines that are not dropped
+    line_start = 0
+    with open(output_path, 'wb') as f:
+        for chunk, _ in read_line_chunks(input_path, chunk_size, limit=limit):
+            lines = split_chunk_lines(chunk)
+            is_kept = drop_kinds[line_start:line_start + len(lines)] == 0
+            f.write(b''.join(line + b'\n' for line in compress(lines, is_kept)))
+            line_start += len(lines)
+
+
+class DuplicateFinderTest(unittest.TestCase):
+    def find_dropped(self, keys, memory_budget):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            duplicate_finder = DuplicateFinder(tmp_path, memory_budget)
+            for start in range(0, len(keys), 100):
+                batch_keys = numpy.array(keys[start:start + 100], dtype=numpy.uint64)
+                duplicate_finder.add(batch_keys, numpy.arange(start, start + len(batch_keys), dtype=numpy.uint64))
+
+            drop_kinds = load_drop_kinds(duplicate_finder.finish(), os.path.join(tmp_path, 'kinds'), len(keys))
+            return numpy.array(drop_kinds), len(duplicate_finder.runs)
+
+    def test_spilled_runs_match_a_set(self):
+        rng = numpy.random.default_rng(0)
+        keys = [int(x) for x in rng.integers(0, 3000, size=5000) * 2 + 2 ** 40 * rng.integers(0, 2, size=5000)]
+        keys = [key | 1 if i % 7 == 0 else key for i, key in enumerate(keys)]
+
+        seen = set()
+        expected = []
+        for key in keys:
+            expected.append(0 if key not in seen else near_duplicate if key & 1 else exact_duplicate)
+            seen.add(key)
+
+        for memory_budget in [1 << 30, 4096, 1024]:
+            drop_kinds, num_runs = self.find_dropped(keys, memory_budget)
+            self.assertEqual(drop_kinds.tolist(), expected)
+            self.assertEqual(num_runs > 0, memory_budget < 1 << 30)
+
+    def test_near_duplicates_share_a_band(self):
+        permutations = minhash_permutations(64)
+        texts = [
+            'we said hello again to the quick brown fox over the lazy dog',
+            'we said hello again to the quick brown fox over the lazy dogs',
+            'a completely different line about something else entirely now',
+        ]
+        keys = band_keys(minhash_signatures(texts, permutations, shingle_size=2), bands=16)
+
+        self.assertTrue(set(keys[0].tolist()) & set(keys[1].tolist()))
+        self.assertFalse(set(keys[0].tolist()) & set(keys[2].tolist()))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--input', type=str)
+    parser.add_argument('--output', type=str)
+    parser.add_argument('--limit', help='Limit number of lines to process', type=int, default=None)
+    parser.add_argument('--language', help='Language of the corpus, lines are compared after its normalization', choices=languages.keys(), default='en')
+    parser.add_argument('--workers', help='Number of processes to run concurrently', type=int, default=1)
+    parser.add_argument('--chunk-size', help='MB of input per task', type=float, default=4)
+    parser.add_argument('--memory-budget', help='MB of line hashes to keep in memory before spilling them to disk', type=int, default=1024)
+    parser.add_argument('--tmp-dir', help='Directory for the spilled hashes, by default the output directory', type=str, default=None)
+    parser.add_argument('--near-duplicates', help='Also drop lines whose MinHash signature shares a band with an earlier line', action='store_true')
+    parser.add_argument('--num-perm', help='MinHash permutations', type=int, default=64)
+    parser.add_argument('--bands', help='LSH bands, each of num-perm / bands signature rows', type=int, default=16)
+    parser.add_argument('--shingle-size', help='Words per MinHash shingle', type=int, default=2)
+    args = parser.parse_args()
+
+    input_path = args.input
+    output_path = args.output
+    chunk_size = int(args.chunk_size * (1 << 20))
+    tmp_path = tempfile.mkdtemp(prefix='dedup-', dir=args.tmp_dir or os.path.dirname(os.path.abspath(output_path)))
+
+    if args.near_duplicates:
+        rows = args.num_perm // args.bands
+        print(f'Near duplicates: {args.bands} bands of {rows} rows, about {(1 / args.bands) ** (1 / rows):.2f} Jaccard similarity')
+        initargs = (args.language, args.num_perm, args.bands, args.shingle_size)
+    else:
+        initargs = (args.language,)
+
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(args.workers, initializer=init_worker, initargs=initargs)
+    else:
+        init_worker(*initargs)
+
+    try:
+        start_time = time.perf_counter()
+        duplicate_finder = DuplicateFinder(tmp_path, args.memory_budget << 20)
+        chunks = read_line_chunks(input_path, chunk_size, limit=args.limit)
+        # Ordered, so the chunks' lines are numbered in input order
+        chunk_results = imap_ordered(pool, hash_chunk, chunks, max_pending=2 * args.workers)
+
+        total_lines, total_bytes = 0, 0
+        with tqdm(total=os.path.getsize(input_path), unit='B', unit_scale=True) as pbar:
+            for num_lines, num_bytes, keys, key_lines, rejected_lines in chunk_results:
+                duplicate_finder.add(keys, key_lines + numpy.uint64(total_lines))
+                duplicate_finder.drop(rejected_lines + numpy.uint64(total_lines), rejected)
+                total_lines += num_lines
+                total_bytes += num_bytes
+                pbar.update(num_bytes)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        hash_time = time.perf_counter() - start_time
+        drop_kinds = load_drop_kinds(duplicate_finder.finish(), os.path.join(tmp_path, 'drop_kinds.u8'), total_lines)
+        write_kept_lines(input_path, output_path, chunk_size, drop_kinds, limit=args.limit)
+        elapsed = time.perf_counter() - start_time
+
+        counts = numpy.bincount(drop_kinds, minlength=4) if total_lines > 0 else numpy.zeros(4, dtype=numpy.int64)
+        num_valid = total_lines - counts[rejected]
+        num_duplicates = counts[exact_duplicate] + counts[near_duplicate]
+        print(
+            f'{total_lines} lines, {counts[rejected]} rejected by the normalization, {counts[exact_duplicate]} exact and '
+            f'{counts[near_duplicate]} near duplicates, {counts[0]} kept. Dedup ratio {num_duplicates / max(num_valid, 1):.1%}, '
+            f'{len(duplicate_finder.runs)} runs spilled'
+        )
+        print(
+            f'{total_bytes / 1e6:.1f} MB hashed in {hash_time:.1f}s, {total_bytes / 1e6 / hash_time:.1f} MB/s, '
+            f'{total_bytes / 1e6 / elapsed:.1f} MB/s overall'
+        )
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
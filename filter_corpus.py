@@ -1,14 +1,42 @@
 from argparse import ArgumentParser
+import multiprocessing
+import os
+import time
 from tqdm import tqdm
 from languages import languages
-from utils import filter_sub_text
+from utils import filter_corpus_text, imap_ordered, read_line_chunks, split_chunk_lines
+
+
+worker_state = {}
+
+
+def init_worker(language_code, skip_blacklisted):
+    worker_state['language'] = languages[language_code]
+    worker_state['skip_blacklisted'] = skip_blacklisted
+
+
+def filter_chunk(chunk_and_size):
+    # Returns the kept lines of a chunk encoded for the output, with the chunk's input and line counts
+    chunk, num_bytes = chunk_and_size
+    language = worker_state['language']
+    skip_blacklisted = worker_state['skip_blacklisted']
+
+    lines = split_chunk_lines(chunk.decode('utf-8'))
+    results = [filter_corpus_text(line, language, skip_blacklisted=skip_blacklisted) for line in lines]
+    output = ''.join(f'{result}\n' for result in results if result is not None).encode('utf-8')
+
+    return output, num_bytes, len(lines), len(results) - results.count(None)
+
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--input', type=str)
     parser.add_argument('--output', type=str)
-    parser.add_argument('--limit', help='Limit number of files to process', type=int, default=None)
+    parser.add_argument('--limit', help='Limit number of lines to process', type=int, default=None)
     parser.add_argument('--language', help='Language of expected subtitles. Used for cleaning the outputs.', choices=languages.keys(), default='en')
+    parser.add_argument('--skip-blacklisted', help="Skip lines containing the language's blacklisted phrases", action='store_true')
+    parser.add_argument('--workers', help='Number of processes to run concurrently', type=int, default=1)
+    parser.add_argument('--chunk-size', help='MB of input per task', type=float, default=4)
     args = parser.parse_args()
 
     limit = args.limit
@@ -16,18 +44,33 @@ if __name__ == '__main__':
     input_path = args.input
     output_path = args.output
 
-    language = languages[language_code]
+    initargs = (language_code, args.skip_blacklisted)
+    chunks = read_line_chunks(input_path, int(args.chunk_size * (1 << 20)), limit=limit)
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(args.workers, initializer=init_worker, initargs=initargs)
+    else:
+        init_worker(*initargs)
 
-    with open(input_path, 'r') as f:
-        lines = f.read().split('\n')
+    start_time = time.perf_counter()
+    total_bytes, total_lines, total_kept = 0, 0, 0
+    # Two chunks per worker in flight, one being filtered and one waiting, plus the results waiting to be written
+    chunk_results = imap_ordered(pool, filter_chunk, chunks, max_pending=2 * args.workers)
 
-    results = []
-    for line in tqdm(lines[:limit]):
-        result = filter_sub_text(line, language)
-        results.append(result)
+    with open(output_path, 'wb') as f, tqdm(total=os.path.getsize(input_path), unit='B', unit_scale=True) as pbar:
+        for output, num_bytes, num_lines, num_kept in chunk_results:
+            f.write(output)
+            total_bytes += num_bytes
+            total_lines += num_lines
+            total_kept += num_kept
+            pbar.update(num_bytes)
 
-    with open(output_path, 'w') as f:
-        for result in results:
-            if result is not None:
-                f.write(f'{result}\n')
+    if pool is not None:
+        pool.close()
+        pool.join()
 
+    elapsed = time.perf_counter() - start_time
+    print(
+        f'{total_lines} lines, {total_kept} kept, {total_bytes / 1e6:.1f} MB in {elapsed:.1f}s, '
+        f'{total_bytes / 1e6 / elapsed:.1f} MB/s'
+    )
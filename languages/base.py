@@ -1,11 +1,72 @@
+import re
+import unittest
+
+
+def compile_blacklist(phrases):
+    # One regex searching for all phrases in a single scan. The phrases are merged into a trie, so phrases sharing
+    # a prefix are compared together instead of each on its own. None when there are no phrases
+    if len(phrases) == 0:
+        return None
+
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def trie_pattern(node):
+        # A phrase ending here already matches, so the longer phrases through this node need not be tried
+        if '' in node:
+            return ''
+        branches = [re.escape(char) + trie_pattern(child) for char, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else f'(?:{"|".join(branches)})'
+
+    return re.compile(trie_pattern(trie))
+
+
 class Language:
+    whitespace_regex = re.compile(r'\s+')
+    # Subtitles containing any of these phrases are skipped, e.g. credits of the translators
+    blacklist = ()
+    blacklist_regex = None
+
+    def __init_subclass__(cls, **kwargs):
+        # Each language's blacklist is compiled once, when its class is defined
+        super().__init_subclass__(**kwargs)
+        cls.blacklist_regex = compile_blacklist(cls.blacklist)
+
     @property
     def name(self):
         raise NotImplementedError()
 
-    @property
-    def blacklist(self):
-        raise NotImplementedError()
+    def is_blacklisted(self, text):
+        return self.blacklist_regex is not None and self.blacklist_regex.search(text) is not None
 
     def filter_text(self, text):
         raise NotImplementedError()
+
+    def filter_text_keep_whitespace(self, text):
+        # filter_text for text whose whitespace is collapsed afterwards. Languages whose filters do not depend
+        # on the whitespace override it, to save collapsing it before as well
+        return self.filter_text(self.whitespace_regex.sub(' ', text))
+
+
+class CompileBlacklistTest(unittest.TestCase):
+    def test_matches_like_substring_search(self):
+        phrases = ['credits:', 'cred', 'subs by', 'sub.', '(c)', 'כתוביות:', 'כתב']
+        blacklist_regex = compile_blacklist(phrases)
+        texts = ['Credits: x', 'credits: x', 'subs b', 'a subs by b', 'sub-', 'sub.', 'x (c) y', 'c)', 'תורגם כתוביות', 'כתובית', '']
+        for text in texts:
+            self.assertEqual(blacklist_regex.search(text) is not None, any(phrase in text for phrase in phrases), text)
+
+    def test_empty(self):
+        self.assertIsNone(compile_blacklist(()))
+
+    def test_compiled_per_language(self):
+        class BlacklistLanguage(Language):
+            blacklist = ('credits:',)
+
+        self.assertTrue(BlacklistLanguage().is_blacklisted('x credits: y'))
+        self.assertFalse(BlacklistLanguage().is_blacklisted('credits'))
+        self.assertIsNone(Language.blacklist_regex)
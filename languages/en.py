@@ -3,15 +3,18 @@ import re
 
 
 class LanguageEnglish(Language):
+    disallowed_chars_regex = re.compile(r"[^a-zA-Z' 0-9]")
+    disallowed_chars_keep_whitespace_regex = re.compile(r"[^a-zA-Z' 0-9\s]")
+    blacklist = ()
+
     @property
     def name(self):
         return 'en'
 
-    @property
-    def blacklist(self):
-        return []
-
     def filter_text(self, text):
         # result = re.sub(r"[^a-zA-Z' \.,?0-9]", '', text)
-        result = re.sub(r"[^a-zA-Z' 0-9]", '', text)
+        result = self.disallowed_chars_regex.sub('', text)
         return result
+
+    def filter_text_keep_whitespace(self, text):
+        return self.disallowed_chars_keep_whitespace_regex.sub('', text)
@@ -1,12 +1,26 @@
 from typing import List, Union
 
 from .base import Language
+from functools import lru_cache
 import re
 import unittest
 import math
 
 
 class LanguageHebrew(Language):
+    numeric_chars = r'\.?0-9\\\/\-'
+    alphabet = 'אבגדהוזחטיכךלמםנןסעפףצץקרשת'
+    disallowed_chars_regex = re.compile(rf"[^{numeric_chars},' {alphabet}]")
+    disallowed_chars_keep_whitespace_regex = re.compile(rf"[^{numeric_chars},' \s{alphabet}]")
+    digits_regex = re.compile(r'[0-9]')
+    # Removes the numeric characters left after the numbers are transformed and maps final letters to regular ones
+    final_translation = str.maketrans('ךםןףץ', 'כמנפצ', '.?0123456789\\/-')
+    blacklist = (
+        'כתוביות:',
+        'תכתוב:',
+        'לשידור:',
+    )
+
     def __init__(self):
         self.number_transformer = NumberTransformer()
 
@@ -14,31 +28,26 @@ class LanguageHebrew(Language):
     def name(self):
         return 'iw'
 
-    @property
-    def blacklist(self):
-        return [
-            'כתוביות:',
-            'תכתוב:',
-            'לשידור:',
-        ]
-
     def filter_text(self, text):
+        return self.filter_allowed_chars(self.disallowed_chars_regex.sub('', text))
+
+    def filter_text_keep_whitespace(self, text):
+        # Numbers never span whitespace, so they are transformed the same whatever the whitespace is
+        return self.filter_allowed_chars(self.disallowed_chars_keep_whitespace_regex.sub('', text))
+
+    def filter_allowed_chars(self, text):
         result = text
-        numeric_chars = r'\.?0-9\\\/\-'
-        alphabet = 'אבגדהוזחטיכךלמםנןסעפףצץקרשת'
-        result = re.sub(rf"[^{numeric_chars},' {alphabet}]", '', result)
-        result = self.number_transformer.transform_text(result)
-        result = re.sub(rf'[{numeric_chars}]', '', result)
-        trans = str.maketrans(
-            'ךםןףץ',
-            'כמנפצ',
-        )
-        result = result.translate(trans)
+        # Only ASCII digits are left, so without them there are no numbers to transform
+        if self.digits_regex.search(result) is not None:
+            result = self.number_transformer.transform_text(result)
+        result = result.translate(self.final_translation)
         return result
 
 
 class NumberTransformer:
     class Part:
+        __slots__ = ('value', 'label', 'decimal')
+
         def __init__(self, value: int = None, label: str = '', decimal: bool = False):
             self.value = value
             self.label = label
@@ -122,10 +131,26 @@ class NumberTransformer:
     }
     symbols_regexp = rf'[{"".join(symbol_labels.keys())}]'
     number_regexp = rf'({symbols_regexp})?(\d[\d,]*(?:\.\d+)?)({symbols_regexp})?'
+    number_regex = re.compile(number_regexp)
+    non_numeric_regex = re.compile(r'[^\d\.]')
+
+    # Whole numbers below this are looked up in a table built on first use and shared by all instances,
+    # larger ones are composed from looked up labels and the rest is kept in an LRU cache of parsed labels
+    table_size = 10000
+    whole_labels = None
+    unit_values = [10 ** power for power in sorted(units, reverse=True)]
+    cache_size = 1 << 16
+
+    def __init__(self):
+        # Only the label strings are cached, parsing changes the labels of the parts it combines
+        self.cached_number_label = lru_cache(maxsize=self.cache_size)(self.parse_number_label)
+
+    # Pickled as a new instance without the cache, e.g. when a language is sent to pool workers
+    def __reduce__(self):
+        return NumberTransformer, ()
 
     def transform_text(self, text):
-        replaced_text = re.sub(
-            self.number_regexp,
+        replaced_text = self.number_regex.sub(
             lambda match: self.transform_number(match.group(2), symbol=match.group(1) or match.group(3)),
             text,
         )
@@ -133,25 +158,50 @@ class NumberTransformer:
 
     def transform_number(self, value, symbol=None):
         if type(value) == str:
-            numeric_str = re.sub(r'[^\d\.]', '', value)
+            numeric_str = self.non_numeric_regex.sub('', value)
             whole, decimal = ([int(x) for x in numeric_str.split('.')] + [None])[:2]
             number = float(numeric_str)
         elif type(value) == int:
             whole, decimal = value, None
             number = whole
 
-        parts = self.parse_whole_number(whole)
-        parts = self.parse_decimal_part(decimal, whole_parts=parts)
-        part_labels = [part.label for part in parts]
+        result = self.number_label(whole, decimal)
 
         if symbol is not None:
             symbol_label = self.symbol_labels[symbol](number)
-            part_labels.append(symbol_label)
-
-        result = ' '.join(part_labels)
+            result = f'{result} {symbol_label}'
 
         return result
 
+    def number_label(self, whole: int, decimal: int = None) -> str:
+        if decimal is None:
+            return self.whole_number_label(whole)
+
+        return self.cached_number_label(whole, decimal)
+
+    def whole_number_label(self, value: int) -> str:
+        if value < self.table_size:
+            if self.whole_labels is None:
+                NumberTransformer.whole_labels = [self.parse_number_label(value) for value in range(self.table_size)]
+            return self.whole_labels[value]
+
+        # As parse_whole_number, split at the largest unit unless it is a multiple of it
+        unit_value = next(unit_value for unit_value in self.unit_values if unit_value <= value)
+        remainder = value % unit_value
+        if remainder == 0 or value in self.labels:
+            return self.cached_number_label(value, None)
+
+        remainder_label = self.whole_number_label(remainder)
+        if remainder < 20:
+            remainder_label = f'ו{remainder_label}'
+
+        return f'{self.whole_number_label(value - remainder)} {remainder_label}'
+
+    def parse_number_label(self, whole: int, decimal: int = None) -> str:
+        parts = self.parse_whole_number(whole)
+        parts = self.parse_decimal_part(decimal, whole_parts=parts)
+        return ' '.join(part.label for part in parts)
+
     def parse_decimal_part(self, decimal_value: int, whole_parts: List[Part]) -> List[Part]:
         if decimal_value is None:
             return whole_parts
@@ -331,6 +381,21 @@ class NumberTransformerTest(unittest.TestCase):
         self.assertEqual(self.number_transformer.transform_number('101.999'), 'מאה ואחת נקודה תשע מאות תשעים ותשע')
         self.assertEqual(self.number_transformer.transform_number('20.55'), 'עשרים נקודה חמישים וחמש')
 
+    def test_lookup_table_matches_parser(self):
+        for value in range(NumberTransformer.table_size):
+            self.assertEqual(self.number_transformer.transform_number(str(value)), self.number_transformer.parse_number_label(value))
+        # Twice, the second from the cache
+        for whole, decimal in [(12345, None), (3, 5), (0, 12345), (1250, 5), (96000000015, None), (22100001, None)] * 2:
+            self.assertEqual(self.number_transformer.number_label(whole, decimal), self.number_transformer.parse_number_label(whole, decimal))
+
+    def test_pickle(self):
+        import pickle
+
+        self.number_transformer.transform_number('1,250.5')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            number_transformer = pickle.loads(pickle.dumps(self.number_transformer, protocol=protocol))
+            self.assertEqual(number_transformer.transform_number('1,250.5'), 'אלף מאתיים חמישים וחצי')
+
     def test_transform_text(self):
         self.assertEqual(
             self.number_transformer.transform_text(
@@ -0,0 +1,211 @@
+from contextlib import ExitStack
+from glob import glob
+import hashlib
+import heapq
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+
+jasper_manifest_keys = ['text', 'duration', 'audio_filepath']
+
+
+def get_shard_suffix(shard_index, num_shards):
+    return f'.shard-{shard_index:03d}-of-{num_shards:03d}' if num_shards > 1 else ''
+
+
+class ManifestWriter:
+    # Appends clip results to the JSON lines manifests as they arrive, fsync'ing every checkpoint_interval clips
+    def __init__(self, out_path, checkpoint_interval=50, suffix=''):
+        self.out_path = out_path
+        self.checkpoint_interval = checkpoint_interval
+        self.manifest_path = os.path.join(out_path, f'manifest{suffix}.json')
+        self.jasper_manifest_path = os.path.join(out_path, f'jasper_manifest{suffix}.json')
+        self.checkpoint_path = os.path.join(out_path, f'checkpoint{suffix}.json')
+        self.completed_clips = 0
+        self.num_items = 0
+        self.manifest_file = None
+        self.jasper_manifest_file = None
+
+    def __enter__(self):
+        self.manifest_file = open(self.manifest_path, 'w')
+        self.jasper_manifest_file = open(self.jasper_manifest_path, 'w')
+        return self
+
+    def __exit__(self, *exc_info):
+        self.checkpoint()
+        self.manifest_file.close()
+        self.jasper_manifest_file.close()
+
+    def write_clip(self, clip_manifest_items):
+        for item in clip_manifest_items:
+            jasper_item = {k: v for k, v in item.items() if k in jasper_manifest_keys}
+            self.manifest_file.write(json.dumps(item, ensure_ascii=False) + '\n')
+            self.jasper_manifest_file.write(json.dumps(jasper_item, ensure_ascii=False) + '\n')
+
+        self.completed_clips += 1
+        self.num_items += len(clip_manifest_items)
+
+        if self.completed_clips % self.checkpoint_interval == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        for f in [self.manifest_file, self.jasper_manifest_file]:
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Byte offsets mark the durable prefix of each manifest, anything after them may be a partial line
+        checkpoint = {
+            'completed_clips': self.completed_clips,
+            'items': self.num_items,
+            'manifest_bytes': self.manifest_file.tell(),
+            'jasper_manifest_bytes': self.jasper_manifest_file.tell(),
+        }
+
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+
+def get_manifest_line_clip(line):
+    return os.path.dirname(json.loads(line)['audio_filepath'])
+
+
+def sort_manifest(manifest_path, run_bytes=64 << 20):
+    # Stable sort by clip directory, segments of a clip keep their original order. Runs of about run_bytes are
+    # sorted in memory and written aside, then merged, so memory does not grow with the manifest
+    run_dir = tempfile.mkdtemp(prefix='sort-', dir=os.path.dirname(os.path.abspath(manifest_path)))
+    try:
+        run_paths = []
+        with open(manifest_path) as f:
+            while True:
+                lines = f.readlines(run_bytes)
+                if len(lines) == 0:
+                    break
+                lines.sort(key=get_manifest_line_clip)
+
+                run_paths.append(os.path.join(run_dir, f'{len(run_paths)}.json'))
+                with open(run_paths[-1], 'w') as run_file:
+                    run_file.writelines(lines)
+                del lines
+
+        # Equal keys are taken from earlier runs first, which keeps the sort stable across runs
+        with ExitStack() as stack, open(manifest_path + '.tmp', 'w') as f:
+            runs = [stack.enter_context(open(run_path)) for run_path in run_paths]
+            f.writelines(heapq.merge(*runs, key=get_manifest_line_clip))
+        os.replace(manifest_path + '.tmp', manifest_path)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def find_shard_manifests(out_path):
+    # Shard manifests by shard index, raises when there are none, shards of a different count are mixed or some are missing
+    shard_manifests = {}
+    num_shards = None
+    for path in glob(os.path.join(out_path, 'manifest.shard-*-of-*.json')):
+        match = re.search(r'\.shard-(\d+)-of-(\d+)\.json$', path)
+        shard_index, shard_count = int(match.group(1)), int(match.group(2))
+        if num_shards is not None and shard_count != num_shards:
+            raise ValueError(f'Shard manifests of {num_shards} and {shard_count} shards are mixed in {out_path}')
+        num_shards = shard_count
+        shard_manifests[shard_index] = path
+
+    # Merging nothing would replace the manifest.json of an unsharded run with an empty one
+    if num_shards is None:
+        raise ValueError(f'No shard manifests in {out_path}')
+
+    missing_shards = sorted(set(range(num_shards)) - set(shard_manifests))
+    if len(missing_shards) > 0:
+        raise ValueError(f'Missing manifests of shards {missing_shards} in {out_path}')
+
+    return [shard_manifests[shard_index] for shard_index in sorted(shard_manifests)]
+
+
+def read_processed_clips(out_path):
+    # Clip files of every shard's metrics, which get a line once a clip is done whether or not it had segments
+    processed_clips = set()
+    for path in glob(os.path.join(out_path, 'metrics.shard-*-of-*.jsonl')):
+        with open(path) as f:
+            for line in f:
+                try:
+                    processed_clips.add(json.loads(line)['clip_file'])
+                except ValueError:
+                    continue
+
+    return processed_clips
+
+
+def merge_manifests(shard_manifest_paths, out_path):
+    # Streams the shard manifests line by line into manifest.json and jasper_manifest.json. Segments already
+    # merged from another shard are dropped, as are partial lines left by a shard that did not finish
+    seen = set()
+    counts = {'items': 0, 'duplicates': 0, 'invalid': 0}
+
+    with open(os.path.join(out_path, 'manifest.json.tmp'), 'w') as manifest_file, \
+        open(os.path.join(out_path, 'jasper_manifest.json.tmp'), 'w') as jasper_manifest_file:
+
+        for shard_manifest_path in shard_manifest_paths:
+            with open(shard_manifest_path) as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        counts['invalid'] += 1
+                        continue
+
+                    # 8 byte digests keep the seen set small for millions of segments
+                    key = hashlib.blake2b(item['audio_filepath'].encode(), digest_size=8).digest()
+                    if key in seen:
+                        counts['duplicates'] += 1
+                        continue
+                    seen.add(key)
+
+                    jasper_item = {k: v for k, v in item.items() if k in jasper_manifest_keys}
+                    manifest_file.write(json.dumps(item, ensure_ascii=False) + '\n')
+                    jasper_manifest_file.write(json.dumps(jasper_item, ensure_ascii=False) + '\n')
+                    counts['items'] += 1
+
+    os.replace(os.path.join(out_path, 'manifest.json.tmp'), os.path.join(out_path, 'manifest.json'))
+    os.replace(os.path.join(out_path, 'jasper_manifest.json.tmp'), os.path.join(out_path, 'jasper_manifest.json'))
+
+    return counts
+
+
+class SortManifestTest(unittest.TestCase):
+    def test_external_sort_is_stable(self):
+        lines = [
+            json.dumps({'audio_filepath': f'manifest/segment-clips/clip{clip % 7}/{i}.wav', 'text': 'x' * (i % 5)}) + '\n'
+            for i, clip in enumerate(range(0, 500, 3))
+        ]
+        expected = sorted(lines, key=get_manifest_line_clip)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest_path = os.path.join(temp_dir, 'manifest.json')
+            # Runs of a single line up to the whole manifest
+            for run_bytes in [1, 1000, 1 << 20]:
+                with open(manifest_path, 'w') as f:
+                    f.writelines(lines)
+                sort_manifest(manifest_path, run_bytes=run_bytes)
+
+                with open(manifest_path) as f:
+                    self.assertEqual(f.readlines(), expected)
+                self.assertEqual(os.listdir(temp_dir), ['manifest.json'])
+
+
+class FindShardManifestsTest(unittest.TestCase):
+    def test_unsharded_output_is_not_merged(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(os.path.join(temp_dir, 'manifest.json'), 'w') as f:
+                f.write('{}\n')
+            with self.assertRaises(ValueError):
+                find_shard_manifests(temp_dir)
+
+            for shard_index in [1, 0]:
+                with open(os.path.join(temp_dir, f'manifest.shard-{shard_index}-of-2.json'), 'w') as f:
+                    f.write('{}\n')
+            self.assertEqual(find_shard_manifests(temp_dir), [os.path.join(temp_dir, f'manifest.shard-{i}-of-2.json') for i in range(2)])
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+import resource
+import sys
+import time
+
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class ClipMetrics:
+    # Per clip timings and counters, returned along with the clip results so no extra IPC is needed
+    def __init__(self, clip_file):
+        self.clip_file = clip_file
+        self.stages = {}
+        self.values = {}
+        self.stage_stack = []
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        # Stage times exclude the time spent in nested stages
+        self.stage_stack.append(0.0)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            nested = self.stage_stack.pop()
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed - nested
+            if len(self.stage_stack) > 0:
+                self.stage_stack[-1] += elapsed
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def to_dict(self):
+        wall_time = time.perf_counter() - self.start_time
+        audio_seconds = self.values.get('audio_seconds', 0)
+
+        return {
+            'clip_file': self.clip_file,
+            'wall_time': wall_time,
+            'stages': self.stages,
+            **self.values,
+            'audio_seconds_per_second': audio_seconds / wall_time if wall_time > 0 else 0,
+            'peak_rss': get_peak_rss(),
+        }
+
+
+class MetricsSummary:
+    # Running totals over clip metrics, so the parent never keeps them all
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.num_clips = 0
+        self.num_cached = 0
+        self.num_errors = 0
+        self.stages = {}
+        self.worker_time = 0.0
+        self.audio_seconds = 0.0
+        self.bytes_written = 0
+        self.peak_rss = 0
+
+    def add(self, clip_metrics):
+        self.num_clips += 1
+        self.num_cached += int(clip_metrics.get('cached', False))
+        self.num_errors += int(clip_metrics.get('error', False))
+        for name, elapsed in clip_metrics['stages'].items():
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+        self.worker_time += clip_metrics['wall_time']
+        self.audio_seconds += clip_metrics.get('audio_seconds', 0)
+        self.bytes_written += clip_metrics.get('bytes_written', 0)
+        self.peak_rss = max(self.peak_rss, clip_metrics['peak_rss'])
+
+    def to_dict(self):
+        wall_time = time.perf_counter() - self.start_time
+
+        return {
+            'clips': self.num_clips,
+            'cached': self.num_cached,
+            'errors': self.num_errors,
+            'wall_time': wall_time,
+            'worker_time': self.worker_time,
+            'stages': self.stages,
+            'audio_seconds': self.audio_seconds,
+            'bytes_written': self.bytes_written,
+            'audio_seconds_per_second': self.audio_seconds / wall_time if wall_time > 0 else 0,
+            'audio_seconds_per_worker_second': self.audio_seconds / self.worker_time if self.worker_time > 0 else 0,
+            'peak_rss': self.peak_rss,
+        }
+
+    def report(self):
+        summary = self.to_dict()
+        stages_time = sum(self.stages.values())
+
+        lines = [
+            f"{summary['clips']} clips ({summary['cached']} cached, {summary['errors']} errors) in {summary['wall_time']:.1f}s",
+            f"{summary['audio_seconds']:.0f}s of audio, {summary['audio_seconds_per_second']:.1f} audio s/s overall, "
+            f"{summary['audio_seconds_per_worker_second']:.1f} audio s/s per worker",
+            f"{summary['bytes_written'] / (1 << 20):.1f} MB written, peak worker RSS {summary['peak_rss'] / (1 << 20):.0f} MB",
+        ]
+        for name, elapsed in sorted(self.stages.items(), key=lambda x: -x[1]):
+            lines.append(f'  {name:<20} {elapsed:10.1f}s {100 * elapsed / stages_time if stages_time > 0 else 0:5.1f}%')
+
+        return '\n'.join(lines)
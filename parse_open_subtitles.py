@@ -1,26 +1,49 @@
-from glob import glob
+from glob import escape, glob, iglob
+from contextlib import contextmanager
 from tqdm import tqdm
-from multiprocessing import Pool
+import gzip
+import itertools
+import multiprocessing
+import os
+import shutil
+import zipfile
 import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
-import utils
 from languages import languages
-from utils import filter_sub_text
+from utils import filter_sub_text, imap_ordered, imap_unordered, batched
 import re
 
 
-def handler(xml_file, language):
-    root = ET.parse(xml_file).getroot()
-    s_tags = root.findall('s')
+document_suffixes = ('.xml', '.xml.gz')
+digit_regex = re.compile(r'\d')
+
+worker_state = {}
+
 
+def handler(xml_file, language):
+    # xml_file is a path or a binary file. It is parsed incrementally, and the sentences are
+    # cleared from the tree once read, so memory does not grow with the document
     sentences = []
-    for s in s_tags:
-        w_tags = s.findall('w')
+    root = None
+    depth = 0
+    for event, element in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            root = root if root is not None else element
+            depth += 1
+            continue
+
+        depth -= 1
+        # Only the <s> children of the root are sentences
+        if depth != 1 or element.tag != 's':
+            continue
+
+        w_tags = element.findall('w')
         words = [w.text for w in w_tags]
         sentence = ' '.join(words)
         sentence = sentence.replace(" '", "'")
+        root.clear()
 
-        if re.search('\d', sentence) is not None:
+        if digit_regex.search(sentence) is not None:
             sentences.append(None)
             continue
 
@@ -30,13 +53,98 @@ def handler(xml_file, language):
     return sentences
 
 
+def find_documents(input_dir_path):
+    # (archive path, member name) of the documents in the .zip archives under input_dir_path, and (None, path)
+    # of the extracted .xml and .xml.gz files. Found lazily, only the archives' member lists are read
+    for path in iglob(f'{input_dir_path}/**/*', recursive=True):
+        if path.endswith(document_suffixes):
+            yield None, path
+        elif path.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                names = archive.namelist()
+            for name in names:
+                if name.endswith(document_suffixes):
+                    yield path, name
+
+
+@contextmanager
+def open_document(archive_path, name):
+    # Reads the document straight from its archive, each worker keeps the archives it read from open
+    if archive_path is None:
+        f = open(name, 'rb')
+    else:
+        archives = worker_state.setdefault('archives', {})
+        if archive_path not in archives:
+            archives[archive_path] = zipfile.ZipFile(archive_path)
+        f = archives[archive_path].open(name)
+
+    with f:
+        if name.endswith('.gz'):
+            with gzip.GzipFile(fileobj=f) as gzip_file:
+                yield gzip_file
+        else:
+            yield f
+
+
+def get_shard_path(output_path, pid):
+    return f'{output_path}.shard-{pid}'
+
+
+def find_shard_paths(output_path):
+    return sorted(glob(f'{escape(output_path)}.shard-*'))
+
+
+def init_worker(language_code, output_path=None):
+    # With an output path each worker appends its sentences to its own shard of the output. Shards are named by
+    # process id, so a worker the pool replaces gets a shard of its own
+    worker_state['language'] = languages[language_code]
+    worker_state['shard_file'] = None
+    if output_path is not None:
+        worker_state['shard_file'] = open(get_shard_path(output_path, os.getpid()), 'ab')
+
+
+def handle_batch(documents):
+    # Returns the document, sentence and kept sentence counts of the batch, and the kept sentences
+    # as the output's bytes unless they were written to the worker's shard
+    num_sentences = 0
+    kept_sentences = []
+    for archive_path, name in documents:
+        with open_document(archive_path, name) as f:
+            sentences = handler(f, worker_state['language'])
+        num_sentences += len(sentences)
+        kept_sentences.extend(sentence for sentence in sentences if sentence is not None)
+
+    output = ''.join(f'{sentence}\n' for sentence in kept_sentences).encode('utf-8')
+
+    shard_file = worker_state['shard_file']
+    if shard_file is not None:
+        # Flushed per batch, pool workers may exit without closing it
+        shard_file.write(output)
+        shard_file.flush()
+        output = b''
+
+    return len(documents), num_sentences, len(kept_sentences), output
+
+
+def concatenate_shards(output_path):
+    # Joins every worker shard into the output and removes them
+    with open(output_path, 'wb') as f:
+        for shard_path in find_shard_paths(output_path):
+            with open(shard_path, 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, f, 1 << 24)
+            os.remove(shard_path)
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--workers', help='Number of processes to run concurrently', type=int, default=12)
     parser.add_argument('--limit', help='Limit number of files to process', type=int, default=None)
     parser.add_argument('--language', help='Language of expected subtitles. Used for cleaning the outputs.', choices=languages.keys(), default='en')
-    parser.add_argument('--input_dir', type=str)
+    parser.add_argument('--input_dir', help='Directory of OpenSubtitles .zip archives, or of extracted .xml or .xml.gz files', type=str)
     parser.add_argument('--output', type=str)
+    parser.add_argument('--batch-size', help='Documents per task', type=int, default=64)
+    parser.add_argument('--ordered', help='Write the sentences in document order instead of as batches complete', action='store_true')
+    parser.add_argument('--shards', help='Each worker writes its own shard of the output, concatenated at the end', action='store_true')
     args = parser.parse_args()
 
     num_workers = args.workers
@@ -44,33 +152,39 @@ if __name__ == '__main__':
     input_dir_path = args.input_dir
     output_path = args.output
     limit = args.limit
-
-    language = languages[language_code]
-
-    xml_files = glob(f'{input_dir_path}/**/*.xml', recursive=True)
-
-    pbar = tqdm(total=len(xml_files))
-
-    def update(*args):
-        pbar.update()
-
-    pool = Pool(num_workers)
-
-    futures = []
-    for xml_file in xml_files[:limit]:
-        future = pool.apply_async(handler, args=(xml_file, language), callback=update)
-        futures.append(future)
-
-    pool.close()
-    pool.join()
-
-    results = []
-    for future in futures:
-        sentences = future.get()
-        results.extend(sentences)
-
-    with open(output_path, 'w') as f:
-        for result in results:
-            if result is not None:
-                f.write(f'{result}\n')
-
+    use_shards = args.shards and num_workers > 1
+
+    if args.ordered and use_shards:
+        parser.error('--ordered cannot be used with --shards')
+
+    documents = itertools.islice(find_documents(input_dir_path), limit)
+    pool = None
+    if num_workers > 1:
+        # Shards of an earlier run would be joined with this one's
+        for shard_path in find_shard_paths(output_path):
+            os.remove(shard_path)
+        initargs = (language_code, output_path if use_shards else None)
+        pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=init_worker, initargs=initargs)
+    else:
+        init_worker(language_code)
+
+    # The parent only holds the encoded sentences of the batches waiting to be written
+    imap = imap_ordered if args.ordered else imap_unordered
+    batch_results = imap(pool, handle_batch, batched(documents, args.batch_size), max_pending=2 * num_workers)
+
+    total_sentences, total_kept = 0, 0
+    with open(output_path, 'wb') as f, tqdm(unit='file') as pbar:
+        for num_documents, num_sentences, num_kept, output in batch_results:
+            f.write(output)
+            total_sentences += num_sentences
+            total_kept += num_kept
+            pbar.update(num_documents)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if use_shards:
+        concatenate_shards(output_path)
+
+    print(f'{total_sentences} sentences, {total_kept} kept')
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+import numpy
+
+
+# Bytes hashed at each end of the source file, catches rewrites that keep the size and mtime
+source_hash_bytes = 1 << 16
+
+
+def get_source_key(file_path, **params):
+    file_stat = os.stat(file_path)
+    h = hashlib.sha256()
+    h.update(json.dumps([os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns, params], sort_keys=True).encode())
+
+    with open(file_path, 'rb') as f:
+        h.update(f.read(source_hash_bytes))
+        if file_stat.st_size > 2 * source_hash_bytes:
+            f.seek(-source_hash_bytes, os.SEEK_END)
+            h.update(f.read(source_hash_bytes))
+
+    return h.hexdigest()
+
+
+def get_silences_key(pcm_key, **params):
+    return hashlib.sha256(json.dumps([pcm_key, params], sort_keys=True).encode()).hexdigest()
+
+
+class PcmCache:
+    # Decoded 16 bit mono PCM and silence points per clip under <cache_path>/<clip id>, read back memory mapped.
+    # The entries' meta.json mtime is their last use, the least recently used are removed past max_bytes.
+    # Other workers may remove an entry at any point, a missing or partial entry is read as a cache miss
+    def __init__(self, cache_path, max_bytes):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+
+    def entry_path(self, clip_id):
+        return os.path.join(self.cache_path, clip_id)
+
+    def read_meta(self, clip_id):
+        try:
+            with open(os.path.join(self.entry_path(clip_id), 'meta.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_meta(self, clip_id, meta):
+        meta_path = os.path.join(self.entry_path(clip_id), 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def load_pcm(self, clip_id, pcm_key):
+        meta = self.read_meta(clip_id)
+        if meta is None or meta['pcm_key'] != pcm_key:
+            return None
+
+        try:
+            os.utime(os.path.join(self.entry_path(clip_id), 'meta.json'))
+
+            if meta['num_samples'] == 0:
+                return numpy.empty(0, dtype='<i2')
+
+            # Copy on write, so tensors made from it are writable without touching the file. Once mapped, the
+            # samples stay readable after the entry is removed
+            return numpy.memmap(os.path.join(self.entry_path(clip_id), 'pcm.raw'), dtype='<i2', mode='c', shape=(meta['num_samples'],))
+        except (OSError, ValueError):
+            return None
+
+    def store_pcm(self, clip_id, pcm_key, samples):
+        entry_path = self.entry_path(clip_id)
+        shutil.rmtree(entry_path, ignore_errors=True)
+        os.makedirs(entry_path, exist_ok=True)
+
+        samples = numpy.ascontiguousarray(samples, dtype='<i2')
+        try:
+            with open(os.path.join(entry_path, 'pcm.raw'), 'wb') as f:
+                f.write(memoryview(samples).cast('B'))
+
+            self.write_meta(clip_id, {'pcm_key': pcm_key, 'num_samples': int(samples.size), 'silences_key': None})
+        except OSError:
+            # Evicted while being written, the clip is decoded again next time
+            return
+        self.evict(keep=clip_id)
+
+    def load_silences(self, clip_id, silences_key):
+        meta = self.read_meta(clip_id)
+        if meta is None or meta['silences_key'] != silences_key:
+            return None
+
+        try:
+            with numpy.load(os.path.join(self.entry_path(clip_id), 'silences.npz')) as silences:
+                return silences['min_points'], silences['edge_points']
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+    def store_silences(self, clip_id, silences_key, silence_min_points, silence_edge_points):
+        meta = self.read_meta(clip_id)
+        if meta is None:
+            return
+
+        # Written aside and renamed, so a concurrent load_silences never reads a partial file
+        silences_path = os.path.join(self.entry_path(clip_id), 'silences.npz')
+        try:
+            with open(silences_path + '.tmp', 'wb') as f:
+                numpy.savez(f, min_points=silence_min_points, edge_points=silence_edge_points)
+            os.replace(silences_path + '.tmp', silences_path)
+            self.write_meta(clip_id, {**meta, 'silences_key': silences_key})
+        except OSError:
+            pass
+
+    def evict(self, keep=None):
+        entries = []
+        for clip_id in os.listdir(self.cache_path):
+            entry_path = self.entry_path(clip_id)
+            try:
+                last_used = os.stat(os.path.join(entry_path, 'meta.json')).st_mtime
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_path))
+            except FileNotFoundError:
+                continue
+            entries.append((last_used, size, clip_id))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, clip_id in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if clip_id == keep:
+                continue
+            # Workers may evict concurrently, and mapped files stay readable after removal
+            shutil.rmtree(self.entry_path(clip_id), ignore_errors=True)
+            total_size -= size
+
+
+class PcmCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.cache = PcmCache(self.temp_dir.name, max_bytes=1 << 20)
+        self.samples = numpy.arange(1000, dtype='<i2')
+        self.min_points, self.edge_points = numpy.array([10, 500]), numpy.array([[5, 15], [490, 510]])
+
+    def store(self):
+        self.cache.store_pcm('clip', 'pcm', self.samples)
+        self.cache.store_silences('clip', 'silences', self.min_points, self.edge_points)
+
+    def test_round_trip(self):
+        self.store()
+        numpy.testing.assert_array_equal(self.cache.load_pcm('clip', 'pcm'), self.samples)
+        min_points, edge_points = self.cache.load_silences('clip', 'silences')
+        numpy.testing.assert_array_equal(min_points, self.min_points)
+        numpy.testing.assert_array_equal(edge_points, self.edge_points)
+        self.assertIsNone(self.cache.load_pcm('clip', 'other'))
+
+    def test_entry_removed_after_meta_is_read(self):
+        # As when another worker evicts the entry between reading its meta.json and its data
+        self.store()
+        meta = self.cache.read_meta('clip')
+        shutil.rmtree(self.cache.entry_path('clip'))
+        self.cache.read_meta = lambda clip_id: meta
+
+        self.assertIsNone(self.cache.load_pcm('clip', 'pcm'))
+        self.assertIsNone(self.cache.load_silences('clip', 'silences'))
+        self.cache.store_silences('clip', 'silences', self.min_points, self.edge_points)
+        self.assertFalse(os.path.exists(self.cache.entry_path('clip')))
+
+    def test_partial_entry(self):
+        self.store()
+        for file_name in ('pcm.raw', 'silences.npz'):
+            with open(os.path.join(self.cache.entry_path('clip'), file_name), 'wb') as f:
+                f.write(b'\0' * 10)
+
+        self.assertIsNone(self.cache.load_pcm('clip', 'pcm'))
+        self.assertIsNone(self.cache.load_silences('clip', 'silences'))
@@ -1,316 +1,640 @@
-from pydub import AudioSegment
-import pysrt
 from glob import glob
 import re
 import os
 import shutil
 import json
-from tqdm import tqdm
-from multiprocessing import Pool, Manager, Process
-import yaml
+import hashlib
+import multiprocessing
 from argparse import ArgumentParser
-import torch
-import torchaudio
-from languages import languages
-from subtitles_align import align_subs_by_clip_silences, create_sub_for_silence_points
-import pynvml
 import traceback
 import time
-from utils import srt_to_audacity_labels, filter_sub_text
-
-
-torch.multiprocessing.set_start_method('spawn', force=True)
+from languages import languages
+from utils import filter_sub_text, normalize_sub_texts, normalizer_version
+from manifest import ManifestWriter, sort_manifest, get_shard_suffix, find_shard_manifests, merge_manifests, read_processed_clips
+from metrics import ClipMetrics, MetricsSummary
+from audio import audio_decoders, decode_audio_ffmpeg, decode_audio_pydub, resample, WavWriter
+from pcm_cache import PcmCache, get_source_key, get_silences_key
+from scheduler import ClipScheduler, probe_durations, estimate_duration, assign_shards, create_tasks, simulate_schedule, default_bytes_per_audio_second, default_audio_seconds_per_worker_second
 
 
-parser = ArgumentParser()
-parser.add_argument('--workers', help='Number of processes to run concurrently', type=int, default=1)
-parser.add_argument('--language', help='Language of expected subtitles. Used for cleaning the outputs.', choices=languages.keys(), default='en')
-parser.add_argument('--language_locales', help='Number of processes to run concurrently', type=str, default=None)
-parser.add_argument('--sample-rate', help='A specific output sample rate', type=int, default=None)
+# torch, pynvml, pysrt and subtitles_align are imported where they are used,
+# so importing this module is cheap and has no side effects
 
-args = parser.parse_args()
+clip_formats = ('webm', 'm4a', 'mp4')
 
 
-num_workers = args.workers
-language_code = args.language
-language_locales = [language_code] if args.language_locales is None else args.language_locales.split(',')
-clip_formats = ('webm', 'm4a', 'mp4')
-out_path = 'manifest'
-segments_path = os.path.join(out_path, 'segment-clips')
-merge_clips_threshold = 2000  # 2 seconds
-max_merge_duration = 10 * 1000   # 10 seconds
-max_word_count = 50
-output_sample_rate = args.sample_rate
-overwrite = False
-target_sample_rate = 16000
-
-language = languages[language_code]
-
-segment_padding = {
-    'start': 0,
-    'end':   0,
-}
-audio_truncate = {
-    'start': 20 * 1000,  # 10 seconds
-    'end':   20 * 1000,  # 10 seconds
-}
-
-clips_blacklist = []
-if os.path.exists('clips_blacklist.yaml'):
-    with open('clips_blacklist.yaml') as f:
-        clips_blacklist = yaml.safe_load(f)
-
-if overwrite:
-    shutil.rmtree(out_path, ignore_errors=True)
-
-os.makedirs(out_path, exist_ok=True)
-os.makedirs(segments_path, exist_ok=True)
-
-
-def process_clip(clip_file, queue, language):
+class ManifestConfig:
+    def __init__(
+        self,
+        language_code='en',
+        language_locales=None,
+        out_path='manifest',
+        decoder='ffmpeg',
+        target_sample_rate=16000,
+        output_sample_rate=None,
+        merge_clips_threshold=2000,  # 2 seconds
+        max_merge_duration=10 * 1000,  # 10 seconds
+        max_word_count=50,
+        segment_padding=None,
+        audio_truncate=None,
+        clips_blacklist=(),
+        silence_detection=None,
+        pcm_cache_size=None,
+    ):
+        self.language_code = language_code
+        self.language_locales = [language_code] if language_locales is None else list(language_locales)
+        self.out_path = out_path
+        self.decoder = decoder
+        self.target_sample_rate = target_sample_rate
+        self.output_sample_rate = output_sample_rate
+        self.merge_clips_threshold = merge_clips_threshold
+        self.max_merge_duration = max_merge_duration
+        self.max_word_count = max_word_count
+        self.segment_padding = segment_padding or {
+            'start': 0,
+            'end':   0,
+        }
+        self.audio_truncate = audio_truncate or {
+            'start': 20 * 1000,  # 20 seconds
+            'end':   20 * 1000,  # 20 seconds
+        }
+        self.clips_blacklist = set(clips_blacklist)
+        self.silence_detection = silence_detection or {
+            'threshold': 0.020,
+            'kernel_size': 8193,
+            'exp': 6,
+        }
+        # Bytes of decoded PCM and silence points kept between runs, None disables the cache
+        self.pcm_cache_size = pcm_cache_size
+
+    @property
+    def language(self):
+        return languages[self.language_code]
+
+    @property
+    def segments_path(self):
+        return os.path.join(self.out_path, 'segment-clips')
+
+    @property
+    def pcm_cache_path(self):
+        return os.path.join(self.out_path, 'pcm-cache')
+
+
+def load_clips_blacklist(path='clips_blacklist.yaml'):
+    if not os.path.exists(path):
+        return set()
+
+    import yaml
+
+    with open(path) as f:
+        return set(yaml.safe_load(f) or [])
+
+
+def find_clip_files(data_path='data'):
+    return [clip for clips in [glob(f'{data_path}/**/*.{clip_format}') for clip_format in clip_formats] for clip in clips]
+
+
+def find_srt_file(clip_file, config):
+    clip_format = re.sub(r'^.+\.(\w+)$', r'\1', clip_file)
+    possible_srt_files = [clip_file.replace(f'.{clip_format}', f'.{locale}.srt') for locale in config.language_locales]
+    return next(filter(lambda possible_srt_file: os.path.exists(possible_srt_file), possible_srt_files), None)
+
+
+def get_clip_cache_key(clip_file, srt_file, config):
+    clip_stat = os.stat(clip_file)
+    with open(srt_file, 'rb') as f:
+        srt_hash = hashlib.sha256(f.read()).hexdigest()
+
+    cache_inputs = {
+        'clip': [os.path.abspath(clip_file), clip_stat.st_size, clip_stat.st_mtime_ns],
+        'srt': [os.path.abspath(srt_file), srt_hash],
+        'language': config.language.name,
+        'blacklist': config.language.blacklist,
+        'normalizer_version': normalizer_version,
+        'decoder': config.decoder,
+        'target_sample_rate': config.target_sample_rate,
+        'silence_detection': config.silence_detection,
+        'merge_clips_threshold': config.merge_clips_threshold,
+        'max_merge_duration': config.max_merge_duration,
+        'max_word_count': config.max_word_count,
+        'segment_padding': config.segment_padding,
+        'audio_truncate': config.audio_truncate,
+    }
+
+    return hashlib.sha256(json.dumps(cache_inputs, sort_keys=True).encode()).hexdigest()
+
+
+def read_clip_cache_key(sub_segment_dir):
     try:
-        clip_audio_tensor = None
-        if torch.cuda.is_available():
-            pynvml.nvmlInit()
-            cuda_devices = [
-                {
-                    'name': f'cuda:{i}',
-                    'used_memory': pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(i)).used,
-                } for i in range(torch.cuda.device_count())
-            ]
-            cuda_devices.sort(key=lambda d: d['used_memory'])
-            lowest_memory_device = cuda_devices[0]
-            device_name = lowest_memory_device['name']
+        with open(os.path.join(sub_segment_dir, 'cache_key')) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def align_clip(clip_file, srt_file, config, device='cpu', metrics=None, duration=None):
+    # Decodes a clip and snaps its subtitles to silences, returns the clip audio of shape (1, 1, N)
+    # with the subtitle texts and their aligned start and end times in ms. An already probed duration
+    # saves the ffmpeg decoder another ffprobe, estimates must not be passed as they size its buffer
+    import pysrt
+    import torch
+    from subtitles_align import find_silence_points, align_times_by_silences
+
+    metrics = metrics or ClipMetrics(clip_file)
+    target_sample_rate = config.target_sample_rate
+
+    clip_id = os.path.basename(os.path.dirname(clip_file))
+    clip_format = re.sub(r'^.+\.(\w+)$', r'\1', clip_file)
+
+    pcm_cache = None
+    clip_samples = None
+    if config.pcm_cache_size is not None:
+        pcm_cache = PcmCache(config.pcm_cache_path, config.pcm_cache_size)
+        pcm_key = get_source_key(clip_file, decoder=config.decoder, sample_rate=target_sample_rate)
+        silences_key = get_silences_key(pcm_key, **config.silence_detection)
+        clip_samples = pcm_cache.load_pcm(clip_id, pcm_key)
+        metrics.set('pcm_cached', clip_samples is not None)
+
+    with metrics.stage('decode'):
+        subs = pysrt.open(srt_file)
+        if clip_samples is not None:
+            clip_audio_tensor = torch.from_numpy(clip_samples).to(device)
+        elif config.decoder == 'ffmpeg':
+            clip_audio_tensor = torch.from_numpy(decode_audio_ffmpeg(clip_file, target_sample_rate, duration=duration)).to(device)
         else:
-            device_name = 'cpu'
-
-        device = torch.device(device_name)
+            clip_audio_tensor, clip_sample_rate = decode_audio_pydub(clip_file, format=clip_format)
+
+    if clip_samples is None and config.decoder != 'ffmpeg':
+        with metrics.stage('resample'):
+            clip_audio_tensor = resample(clip_audio_tensor, clip_sample_rate, target_sample_rate, device=device)
+            # Cached PCM is 16 bit, rounded here as well so runs with and without a cache hit agree
+            if pcm_cache is not None:
+                clip_audio_tensor = clip_audio_tensor.round().clamp(-(1 << 15), (1 << 15) - 1).short()
+
+    if pcm_cache is not None and clip_samples is None:
+        with metrics.stage('pcm_cache'):
+            pcm_cache.store_pcm(clip_id, pcm_key, clip_audio_tensor.cpu().numpy())
+
+    clip_audio_tensor = clip_audio_tensor[None, None, :]
+    metrics.set('audio_seconds', clip_audio_tensor.shape[-1] / target_sample_rate)
+
+    silence_points = pcm_cache.load_silences(clip_id, silences_key) if pcm_cache is not None else None
+    if silence_points is not None:
+        silence_min_points, silence_points = silence_points
+    else:
+        with metrics.stage('silence_detection'):
+            silence_min_points, silence_points = find_silence_points(clip_audio_tensor, target_sample_rate, device, **config.silence_detection)
+
+        if pcm_cache is not None:
+            with metrics.stage('pcm_cache'):
+                pcm_cache.store_silences(clip_id, silences_key, silence_min_points, silence_points)
+
+    with metrics.stage('alignment'):
+        sub_start_times, sub_end_times = align_times_by_silences(
+            start_times=[sub.start.ordinal for sub in subs],
+            end_times=[sub.end.ordinal for sub in subs],
+            silence_edge_points=silence_points,
+            sample_rate=target_sample_rate,
+        )
+        sub_start_times, sub_end_times = sub_start_times.tolist(), sub_end_times.tolist()
+        sub_texts = [re.sub('&[^&;]{1,8};', '', sub.text_without_tags) for sub in subs]
+    # silence_subs = create_sub_for_silence_points(silence_points, target_sample_rate)
+
+    # silence_srt_file = srt_file.replace('.srt', '.silence.srt')
+    # silence_subs.save(silence_srt_file)
+    #
+    # aligned_srt_file = srt_file.replace('.srt', '.aligned.srt')
+    # subs.save(aligned_srt_file)
+    #
+    # srt_to_audacity_labels(srt_file, srt_file.replace('.srt', '.txt'))
+    # srt_to_audacity_labels(aligned_srt_file, aligned_srt_file.replace('.srt', '.txt'))
+    # srt_to_audacity_labels(silence_srt_file, silence_srt_file.replace('.srt', '.txt'))
+
+    return clip_audio_tensor, sub_texts, sub_start_times, sub_end_times
+
+
+def segment_subtitles(sub_texts, sub_start_times, sub_end_times, clip_duration_ms, config, sub_pieces=None):
+    # Merges consecutive aligned subtitles into segments, only reads the segmentation settings of config
+    # and never touches the audio, so several configs can be tried on one alignment.
+    # sub_pieces are the subtitles' normalize_sub_texts, computed here when not given
+    language = config.language
+    segment_padding = config.segment_padding
+    audio_truncate = config.audio_truncate
+
+    if sub_pieces is None:
+        sub_pieces = normalize_sub_texts(sub_texts, language)
+
+    acc_sub_start_ms = None
+    acc_sub_end_ms = None
+    acc_sub_texts = []
+    # Normalized text of the accumulated subtitles in pieces, one piece per non empty subtitle while they are
+    # all self contained, the normalized joined text otherwise
+    acc_pieces = []
+    acc_word_count = 0
+    acc_self_contained = True
+    segments = []
+    for i in range(len(sub_texts)):
+        sub_text = sub_texts[i]
+
+        if language.is_blacklisted(sub_text):
+            continue
+
+        sub_start_ms = sub_start_times[i]
+        sub_end_ms = sub_end_times[i]
+
+        if sub_end_ms + segment_padding['end'] > clip_duration_ms - audio_truncate['end']:
+            break
 
-        clip_id = os.path.basename(os.path.dirname(clip_file))
-        clip_format = re.sub(r'^.+\.(\w+)$', r'\1', clip_file)
+        if sub_start_ms - segment_padding['start'] < audio_truncate['start']:
+            continue
 
-        if clip_id in clips_blacklist:
-            return []
-
-        sub_segment_dir_final = os.path.join(segments_path, clip_id)
-        if os.path.exists(os.path.join(sub_segment_dir_final, 'clip_manifest.json')):
-            with open(os.path.join(sub_segment_dir_final, 'clip_manifest.json')) as f:
-                clip_manifest = json.load(f)
+        acc_sub_texts.append(sub_text)
+        sub_piece, sub_self_contained = sub_pieces[i]
+        if acc_self_contained and sub_self_contained:
+            is_rejected = sub_piece is None and len(acc_pieces) == 0
+            if sub_piece is not None:
+                acc_pieces.append(sub_piece)
+                acc_word_count += sub_piece.count(' ') + 1
+        else:
+            # A removal may match across subtitles, so from here on the joined text is normalized
+            filtered_sub_text = filter_sub_text(' '.join(acc_sub_texts), language)
+            is_rejected = filtered_sub_text is None
+            if not is_rejected:
+                acc_pieces = [filtered_sub_text]
+                acc_word_count = filtered_sub_text.count(' ') + 1
+                acc_self_contained = False
+
+        # In case subtitle is rejected
+        if is_rejected:
+            del acc_sub_texts[-1]
+        else:
+            acc_sub_end_ms = sub_end_ms
+
+            if acc_sub_start_ms is None:
+                acc_sub_start_ms = sub_start_ms
+
+            is_last_subtitle = i == len(sub_texts) - 1
+            if not is_last_subtitle:
+                time_between_subs = sub_start_times[i + 1] - sub_end_ms
+                new_acc_duration = sub_end_ms - acc_sub_start_ms
+                if (
+                    new_acc_duration <= config.max_merge_duration and
+                    time_between_subs <= config.merge_clips_threshold and
+                    acc_word_count <= config.max_word_count
+                ):
+                    continue
+
+        if acc_sub_end_ms is not None:
+            segments.append({
+                'start_ms': acc_sub_start_ms - segment_padding['start'],
+                'end_ms': acc_sub_end_ms + segment_padding['end'],
+                'text': ' '.join(acc_pieces),
+                'acc_sub_texts': acc_sub_texts,
+            })
 
-                clip_manifest = [{**x, 'text': filter_sub_text(' '.join(x['acc_sub_texts']), language)} for x in clip_manifest]
+        acc_sub_texts = []
+        acc_pieces = []
+        acc_word_count = 0
+        acc_self_contained = True
+        acc_sub_start_ms = None
+        acc_sub_end_ms = None
 
-                return clip_manifest
+    return segments
 
-        possible_srt_files = [clip_file.replace(f'.{clip_format}', f'.{locale}.srt') for locale in language_locales]
-        srt_file = next(filter(lambda possible_srt_file: os.path.exists(possible_srt_file), possible_srt_files), None)
 
-        if srt_file is None:
-            print(f'Could not find {srt_file}')
-            return []
+def write_clip_segments(clip_file, clip_audio_tensor, segments, config, cache_key, metrics=None):
+    # Writes the segments' audio and the clip manifest to a temporary directory, renamed into place once complete
+    metrics = metrics or ClipMetrics(clip_file)
+    target_sample_rate = config.target_sample_rate
 
-        queue.put({'action': 'set_description', 'pid': os.getpid(), 'description': f'{device_name} {clip_id}'})
+    clip_id = os.path.basename(os.path.dirname(clip_file))
+    sub_segment_dir_final = os.path.join(config.segments_path, clip_id)
 
-        sub_segment_dir = sub_segment_dir_final + '.tmp'
-        if os.path.exists(sub_segment_dir):
-            shutil.rmtree(sub_segment_dir)
+    sub_segment_dir = sub_segment_dir_final + '.tmp'
+    if os.path.exists(sub_segment_dir):
+        shutil.rmtree(sub_segment_dir)
 
-        if os.path.exists(sub_segment_dir_final):
-            os.rename(sub_segment_dir_final, sub_segment_dir)
+    # Segments of a stale run may not be produced again with the current inputs
+    if os.path.exists(sub_segment_dir_final):
+        shutil.rmtree(sub_segment_dir_final)
 
-        os.makedirs(sub_segment_dir, exist_ok=True)
+    os.makedirs(sub_segment_dir, exist_ok=True)
 
-        subs = pysrt.open(srt_file)
-        clip_audio = AudioSegment.from_file(clip_file, format=clip_format)
-        clip_audio = clip_audio.set_channels(1)
-        clip_sample_rate = clip_audio.frame_rate
-        scale_factor = target_sample_rate / clip_sample_rate
-        clip_audio_tensor = torch.tensor([[clip_audio.get_array_of_samples()]], dtype=torch.float32, device=device)
-        clip_audio_tensor = torch.nn.functional.interpolate(clip_audio_tensor, scale_factor=scale_factor, recompute_scale_factor=False)
-        silence_points = align_subs_by_clip_silences(waveform=clip_audio_tensor, sample_rate=target_sample_rate, subs=subs, device=device)
-        # silence_subs = create_sub_for_silence_points(silence_points, target_sample_rate)
-
-        # silence_srt_file = srt_file.replace('.srt', '.silence.srt')
-        # silence_subs.save(silence_srt_file)
-        #
-        # aligned_srt_file = srt_file.replace('.srt', '.aligned.srt')
-        # subs.save(aligned_srt_file)
-        #
-        # srt_to_audacity_labels(srt_file, srt_file.replace('.srt', '.txt'))
-        # srt_to_audacity_labels(aligned_srt_file, aligned_srt_file.replace('.srt', '.txt'))
-        # srt_to_audacity_labels(silence_srt_file, silence_srt_file.replace('.srt', '.txt'))
-
-        clip_duration_ms = len(clip_audio)
+    # Segments are written from views of one 16 bit copy of the clip, none when it is already 16 bit on the CPU
+    clip_samples = clip_audio_tensor[0, 0].cpu()
+    if clip_samples.is_floating_point():
+        clip_samples = clip_samples.round().clamp(-(1 << 15), (1 << 15) - 1)
+    clip_samples = clip_samples.numpy().astype('<i2', copy=False)
 
-        acc_sub_start_ms = None
-        acc_sub_end_ms = None
-        acc_sub_texts = []
-        clip_manifest_items = []
-        for i in range(len(subs)):
-            sub = subs[i]
+    clip_manifest_items = []
+    with WavWriter() as wav_writer:
+        for segment in segments:
+            audio_start_ms = segment['start_ms']
+            audio_end_ms = segment['end_ms']
+            duration_in_ms = audio_end_ms - audio_start_ms
 
-            sub_text = sub.text_without_tags
-            sub_text = re.sub('&[^&;]{1,8};', '', sub_text)
+            sub_segment_file_name = f'{audio_start_ms}-{audio_end_ms}.wav'
 
-            if any(x in sub_text for x in language.blacklist):
-                continue
+            audio_start = audio_start_ms * (target_sample_rate // 1000)
+            audio_end = audio_end_ms * (target_sample_rate // 1000)
 
-            sub_start_ms = sub.start.ordinal
-            sub_end_ms = sub.end.ordinal
+            audio_output_path = os.path.join(sub_segment_dir, sub_segment_file_name)
+            with metrics.stage('write'):
+                wav_writer.write(audio_output_path, clip_samples[audio_start:audio_end], target_sample_rate)
 
-            if sub_end_ms + segment_padding['end'] > clip_duration_ms - audio_truncate['end']:
-                break
+            manifest_item = {
+                'text': segment['text'],
+                'duration': duration_in_ms / 1000,
+                'audio_filepath': os.path.join(sub_segment_dir_final, sub_segment_file_name),
+                'acc_sub_texts': segment['acc_sub_texts'],
+            }
 
-            if sub_start_ms - segment_padding['start'] < audio_truncate['start']:
-                continue
+            clip_manifest_items.append(manifest_item)
 
-            acc_sub_texts.append(sub_text)
-            filtered_sub_text = filter_sub_text(' '.join(acc_sub_texts), language)
+        # Every segment is on disk before the directory is renamed into place
+        with metrics.stage('write'):
+            wav_writer.close()
 
-            # In case subtitle is rejected
-            if filtered_sub_text is None:
-                del acc_sub_texts[-1]
-            else:
-                acc_sub_end_ms = sub_end_ms
-
-                if acc_sub_start_ms is None:
-                    acc_sub_start_ms = sub_start_ms
-
-                is_last_subtitle = i == len(subs) - 1
-                if not is_last_subtitle:
-                    next_sub = subs[i+1]
-                    time_between_subs = next_sub.start.ordinal - sub.end.ordinal
-                    word_count = filtered_sub_text.count(' ') + 1
-                    new_acc_duration = sub.end.ordinal - acc_sub_start_ms
-                    if (
-                        new_acc_duration <= max_merge_duration and
-                        time_between_subs <= merge_clips_threshold and
-                        word_count <= max_word_count
-                    ):
-                        continue
-
-            if acc_sub_end_ms is not None:
-                filtered_sub_text = filter_sub_text(' '.join(acc_sub_texts), language)
-
-                audio_start_ms = acc_sub_start_ms - segment_padding['start']
-                audio_end_ms = acc_sub_end_ms + segment_padding['end']
-                duration_in_ms = audio_end_ms - audio_start_ms
-
-                sub_segment_file_name = f'{audio_start_ms}-{audio_end_ms}.wav'
-
-                audio_start = audio_start_ms * (target_sample_rate // 1000)
-                audio_end = audio_end_ms * (target_sample_rate // 1000)
-
-                sub_audio_tensor = clip_audio_tensor[0, :, audio_start:audio_end] << 16
-                audio_output_path = os.path.join(sub_segment_dir, sub_segment_file_name)
-                torchaudio.save(filepath=audio_output_path, src=sub_audio_tensor.cpu(), sample_rate=target_sample_rate, precision=16)
-
-                manifest_item = {
-                    'text': filtered_sub_text,
-                    'duration': duration_in_ms / 1000,
-                    'audio_filepath': os.path.join(sub_segment_dir_final, sub_segment_file_name),
-                    'acc_sub_texts': acc_sub_texts,
-                }
-
-                clip_manifest_items.append(manifest_item)
-
-            acc_sub_texts = []
-            acc_sub_start_ms = None
-            acc_sub_end_ms = None
+    metrics.set('segments', len(clip_manifest_items))
+    metrics.add('bytes_written', wav_writer.bytes_written)
 
+    with metrics.stage('write'):
         with open(os.path.join(sub_segment_dir, 'clip_manifest.json'), 'w') as f:
             json.dump(clip_manifest_items, f, indent=True, ensure_ascii=False)
 
+        # Written last, a directory without it is never treated as a cache hit
+        with open(os.path.join(sub_segment_dir, 'cache_key'), 'w') as f:
+            f.write(cache_key)
+
         os.rename(sub_segment_dir, sub_segment_dir_final)
 
-        queue.put({'action': 'set_description', 'pid': os.getpid(), 'description': None})
+    return clip_manifest_items
 
-        return clip_manifest_items
-    except Exception:
-        traceback.print_exc()
-    finally:
-        if clip_audio_tensor is not None:
-            del clip_audio_tensor
-        # if torch.cuda.is_available():
-        #     torch.cuda.ipc_collect()
-        #     torch.cuda.empty_cache()
 
+def prepare_clip(clip_file, srt_file, config, device='cpu', metrics=None, duration=None):
+    # Aligns the subtitles of a clip, writes its segments under config.segments_path and returns their manifest items
+    metrics = metrics or ClipMetrics(clip_file)
 
-def update(*args):
-    queue.put({'action': 'increment_bar'})
+    clip_id = os.path.basename(os.path.dirname(clip_file))
+    sub_segment_dir_final = os.path.join(config.segments_path, clip_id)
+    cache_key = get_clip_cache_key(clip_file, srt_file, config)
+    if read_clip_cache_key(sub_segment_dir_final) == cache_key:
+        metrics.set('cached', True)
+        # The texts were filtered by the same language, blacklist and normalizer_version, all part of the cache key
+        with open(os.path.join(sub_segment_dir_final, 'clip_manifest.json')) as f:
+            return json.load(f)
 
+    clip_audio_tensor, sub_texts, sub_start_times, sub_end_times = align_clip(clip_file, srt_file, config, device=device, metrics=metrics, duration=duration)
+    clip_duration_ms = clip_audio_tensor.shape[-1] * 1000 // config.target_sample_rate
 
-def watch_queue(queue, total, num_workers):
-    pbar = tqdm(total=total)
-    worker_description_dict = {}
-    completed = 0
+    with metrics.stage('segmentation'):
+        segments = segment_subtitles(sub_texts, sub_start_times, sub_end_times, clip_duration_ms, config)
 
-    while True:
-        msg = queue.get()
+    return write_clip_segments(clip_file, clip_audio_tensor, segments, config, cache_key, metrics=metrics)
 
-        if msg['action'] == 'quit':
-            break
-        if msg['action'] == 'increment_bar':
-            completed += 1
-        elif msg['action'] == 'set_description':
-            worker_pid = msg['pid']
-            worker_description = msg['description']
-            if worker_description is None:
-                del worker_description_dict[worker_pid]
-            else:
-                worker_description_dict[worker_pid] = worker_description
 
-        worker_descriptions_list = (list(worker_description_dict.values()) + ['None'] * num_workers)[:num_workers]
+def select_device():
+    import torch
 
-        bar_description = f"[{', '.join(worker_descriptions_list)}]"
-        pbar.set_description(bar_description)
-        pbar.n = completed
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
 
+    import pynvml
 
+    # Pool workers are numbered from 1, each takes the next GPU in turn
+    identity = multiprocessing.current_process()._identity
+    worker_index = identity[0] - 1 if len(identity) > 0 else 0
 
-if __name__ == '__main__':
-    pool = Pool(num_workers)
-    manager = Manager()
-    queue = manager.Queue()
-    clip_files = [clip for clips in [glob(f'data/**/*.{clip_format}') for clip_format in clip_formats] for clip in clips]
-    total = len(clip_files)
+    pynvml.nvmlInit()
+    cuda_devices = [
+        {
+            'name': f'cuda:{i}',
+            'used_memory': pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(i)).used,
+        } for i in range(torch.cuda.device_count())
+    ]
+    cuda_devices.sort(key=lambda d: d['used_memory'])
 
+    return torch.device(cuda_devices[worker_index % len(cuda_devices)]['name'])
 
-    watch_queue_thread = Process(target=watch_queue, args=[queue, total, num_workers])
-    watch_queue_thread.start()
 
-    futures = []
-    results = []
-    for i, clip_file in enumerate(clip_files):
-        if num_workers > 1:
-            future = pool.apply_async(process_clip, [clip_file, queue, language], callback=update)
-            futures.append(future)
-        else:
-            result = process_clip(clip_file, queue, language)
-            results.append(result)
-            update()
+# Loaded once per process by init_worker, so tasks only carry the clip path
+worker_state = {}
+
+
+def init_worker(config, num_threads):
+    import torch
+    from subtitles_align import get_gaussian_kernel
 
-    pool.close()
-    pool.join()
+    # Workers share the CPU, so each gets its share of intra-op threads instead of one per core
+    torch.set_num_threads(num_threads)
 
-    queue.put({'action': 'quit'})
-    watch_queue_thread.join()
+    worker_state['config'] = config
+    worker_state['device'] = select_device()
 
-    for future in futures:
-        result = future.get()
-        results.append(result)
+    # Built once here rather than on the first clip of every worker
+    get_gaussian_kernel(config.silence_detection['kernel_size'], str(worker_state['device']))
 
-    manifest = []
-    for result in results:
-        if result is not None:
-            manifest.extend(result)
 
-    with open(os.path.join(out_path, 'manifest.json'), 'w') as f:
-        json.dump(manifest, f, ensure_ascii=False, indent=True)
+def process_clip(clip_file, metrics, duration=None):
+    config = worker_state['config']
 
-    with open(os.path.join(out_path, 'jasper_manifest.json'), 'w') as f:
-        for item in manifest:
-            obj = {k: v for k, v in item.items() if k in ['text', 'duration', 'audio_filepath']}
-            json.dump(obj, f, ensure_ascii=False)
-            f.write('\n')
+    try:
+        clip_id = os.path.basename(os.path.dirname(clip_file))
+        if clip_id in config.clips_blacklist:
+            return []
+
+        srt_file = find_srt_file(clip_file, config)
+        if srt_file is None:
+            print(f'Could not find {srt_file}')
+            return []
 
+        return prepare_clip(clip_file, srt_file, config, device=worker_state['device'], metrics=metrics, duration=duration)
+    except Exception:
+        traceback.print_exc()
+        metrics.set('error', True)
+
+
+def process_clip_with_metrics(clip_file, duration=None):
+    metrics = ClipMetrics(clip_file)
+    clip_manifest_items = process_clip(clip_file, metrics, duration=duration)
+    return clip_manifest_items, metrics.to_dict()
+
+
+def read_previous_speed(summary_path):
+    # Audio seconds per worker second measured by a previous run, None without one or if all its clips were cached
+    try:
+        with open(summary_path) as f:
+            summary = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if summary.get('clips', 0) == summary.get('cached', 0):
+        return None
+    return summary.get('audio_seconds_per_worker_second') or None
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument('--workers', help='Number of processes to run concurrently, defaults to the CPU count with --memory-budget and 1 otherwise', type=int, default=None)
+    parser.add_argument('--memory-budget', help='Estimated memory in MB the clips in flight may use, bounds how many clips run concurrently', type=int, default=None)
+    parser.add_argument('--threads-per-worker', help='Torch intra-op threads of each worker, defaults to the CPU count divided by the number of workers', type=int, default=None)
+    parser.add_argument('--bytes-per-audio-second', help='Estimated worker memory per second of clip audio, used with --memory-budget', type=int, default=default_bytes_per_audio_second)
+    parser.add_argument('--audio-seconds-per-second', help="Estimated seconds of audio a worker processes per second, used to predict the makespan. Defaults to the previous run's measured speed", type=float, default=None)
+    parser.add_argument('--language', help='Language of expected subtitles. Used for cleaning the outputs.', choices=languages.keys(), default='en')
+    parser.add_argument('--language_locales', help='Number of processes to run concurrently', type=str, default=None)
+    parser.add_argument('--sample-rate', help='A specific output sample rate', type=int, default=None)
+    parser.add_argument('--checkpoint-interval', help='Number of clips between fsync checkpoints of the manifests', type=int, default=50)
+    parser.add_argument('--sort-manifests', help='Sort the manifests by clip once all clips are processed', action='store_true')
+    parser.add_argument('--pcm-cache-size', help='MB of decoded audio and silence points to keep for later runs, disabled by default', type=int, default=None)
+    parser.add_argument('--decoder', help='Decode clips by piping PCM from ffmpeg, or through pydub', choices=audio_decoders, default='ffmpeg')
+    parser.add_argument('--num-shards', help='Number of machines the clips are split between', type=int, default=1)
+    parser.add_argument('--shard-index', help='Shard of the clips this run processes, from 0 to --num-shards - 1', type=int, default=0)
+
+    subparsers = parser.add_subparsers(dest='command')
+    merge_parser = subparsers.add_parser('merge', help='Combine the shard manifests into manifest.json and jasper_manifest.json')
+    merge_parser.add_argument('--out-path', help='Directory of the shard manifests', type=str, default='manifest')
+    # Its own dest, the subparser's default would otherwise replace a --sort-manifests given before merge
+    merge_parser.add_argument('--sort-manifests', help='Sort the merged manifests by clip', dest='sort_merged_manifests', action='store_true')
+    merge_parser.add_argument('--data-path', help='Directory of the clips, to report those no shard processed', type=str, default='data')
+
+    args = parser.parse_args(argv)
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error('--shard-index must be between 0 and --num-shards - 1')
+
+    return args
+
+
+def merge(args):
+    try:
+        shard_manifest_paths = find_shard_manifests(args.out_path)
+    except ValueError as e:
+        raise SystemExit(f'Cannot merge: {e}')
+    counts = merge_manifests(shard_manifest_paths, args.out_path)
+
+    if args.sort_manifests or args.sort_merged_manifests:
+        sort_manifest(os.path.join(args.out_path, 'manifest.json'))
+        sort_manifest(os.path.join(args.out_path, 'jasper_manifest.json'))
+
+    print(f"Merged {len(shard_manifest_paths)} shards: {counts['items']} items, {counts['duplicates']} duplicates and {counts['invalid']} partial lines dropped")
+
+    # Clips that no shard finished, e.g. a shard that crashed or ran on a different set of clips
+    processed_clips = read_processed_clips(args.out_path)
+    missing_clips = sorted(set(find_clip_files(args.data_path)) - processed_clips)
+    missing_clips_path = os.path.join(args.out_path, 'missing_clips.txt')
+    if len(missing_clips) > 0:
+        with open(missing_clips_path, 'w') as f:
+            f.writelines(f'{clip_file}\n' for clip_file in missing_clips)
+        print(f'{len(missing_clips)} clips are missing from every shard, listed in {missing_clips_path}')
+    elif os.path.exists(missing_clips_path):
+        os.remove(missing_clips_path)
+
+
+def main(argv=None):
+    from tqdm import tqdm
+
+    args = parse_args(argv)
+    if args.command == 'merge':
+        return merge(args)
+
+    config = ManifestConfig(
+        language_code=args.language,
+        language_locales=None if args.language_locales is None else args.language_locales.split(','),
+        decoder=args.decoder,
+        output_sample_rate=args.sample_rate,
+        clips_blacklist=load_clips_blacklist(),
+        pcm_cache_size=args.pcm_cache_size << 20 if args.pcm_cache_size is not None else None,
+    )
+    memory_budget = args.memory_budget << 20 if args.memory_budget is not None else None
+    num_workers = args.workers or (os.cpu_count() if memory_budget is not None else 1)
+    threads_per_worker = args.threads_per_worker or max(os.cpu_count() // num_workers, 1)
+
+    os.makedirs(config.out_path, exist_ok=True)
+    os.makedirs(config.segments_path, exist_ok=True)
+    if config.pcm_cache_size is not None:
+        os.makedirs(config.pcm_cache_path, exist_ok=True)
+
+    clip_files = sorted(find_clip_files())
+    shard_suffix = get_shard_suffix(args.shard_index, args.num_shards)
+    if args.num_shards > 1:
+        # Balanced by durations estimated from the file sizes, which every node reads the same from the shared
+        # corpus, unlike probed durations. Only this shard's clips are probed
+        estimated_durations = [estimate_duration(clip_file) for clip_file in clip_files]
+        shard_indices = assign_shards(clip_files, estimated_durations, args.num_shards)
+        clip_files = [clip_file for clip_file, shard_index in zip(clip_files, shard_indices) if shard_index == args.shard_index]
+    durations = probe_durations(clip_files)
+
+    total = len(clip_files)
+    tasks = create_tasks(clip_files, durations, bytes_per_audio_second=args.bytes_per_audio_second)
+
+    # Predicted before anything runs, from the configured speed or the one measured by the previous run, so
+    # comparing it with the makespan shows how good the estimate and the schedule were
+    summary_path = os.path.join(config.out_path, f'metrics_summary{shard_suffix}.json')
+    audio_seconds_per_worker_second, speed_source = args.audio_seconds_per_second, 'configured'
+    if audio_seconds_per_worker_second is None:
+        audio_seconds_per_worker_second, speed_source = read_previous_speed(summary_path), 'previous run'
+    if audio_seconds_per_worker_second is None:
+        audio_seconds_per_worker_second, speed_source = default_audio_seconds_per_worker_second, 'default'
+    predicted_makespan = simulate_schedule(tasks, num_workers, memory_budget, audio_seconds_per_worker_second)
+    ideal_makespan = max(
+        max([task.duration for task in tasks], default=0),
+        sum(task.duration for task in tasks) / num_workers,
+    ) / audio_seconds_per_worker_second
+
+    # The makespan includes spawning the pool, the first clip is dispatched right after
+    start_time = time.perf_counter()
+
+    # Results are consumed in completion order and appended to the manifests right away
+    if num_workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=init_worker, initargs=(config, threads_per_worker))
+        clip_results = ClipScheduler(pool, process_clip_with_metrics, num_workers, memory_budget=memory_budget).run(tasks)
+    else:
+        init_worker(config, threads_per_worker)
+        clip_results = ((task, process_clip_with_metrics(task.clip_file, task.probed_duration)) for task in tasks)
+
+    metrics_summary = MetricsSummary()
+    with ManifestWriter(config.out_path, checkpoint_interval=args.checkpoint_interval, suffix=shard_suffix) as manifest_writer, \
+        open(os.path.join(config.out_path, f'metrics{shard_suffix}.jsonl'), 'w') as metrics_file, \
+        tqdm(total=total) as pbar:
+
+        for task, (clip_manifest_items, clip_metrics) in clip_results:
+            manifest_writer.write_clip(clip_manifest_items or [])
+            metrics_file.write(json.dumps(clip_metrics) + '\n')
+            metrics_summary.add(clip_metrics)
+
+            pbar.set_postfix(audio_per_second=f"{metrics_summary.to_dict()['audio_seconds_per_second']:.1f}")
+            pbar.update()
+
+    makespan = time.perf_counter() - start_time
+    if num_workers > 1:
+        pool.close()
+        pool.join()
+
+    if args.sort_manifests:
+        sort_manifest(manifest_writer.manifest_path)
+        sort_manifest(manifest_writer.jasper_manifest_path)
+
+    # The replay runs the same schedule at the measured speed, so it tells how much of the makespan is lost to
+    # the order and sizes of the clips and to pool overhead rather than to the speed estimate
+    summary = metrics_summary.to_dict()
+    measured_speed = summary['audio_seconds_per_worker_second']
+    summary['makespan'] = makespan
+    summary['estimated_audio_seconds_per_worker_second'] = audio_seconds_per_worker_second
+    summary['predicted_makespan'] = predicted_makespan
+    summary['ideal_makespan'] = ideal_makespan
+    summary['replayed_makespan'] = simulate_schedule(tasks, num_workers, memory_budget, measured_speed) if measured_speed > 0 else None
+
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=True)
+
+    print(metrics_summary.report())
+    print(
+        f"Makespan {makespan:.1f}s, predicted {predicted_makespan:.1f}s at {audio_seconds_per_worker_second:.1f} audio s/s per worker "
+        f"({speed_source}), lower bound {ideal_makespan:.1f}s"
+    )
+    if summary['replayed_makespan'] is not None:
+        print(f"Replayed at the measured {measured_speed:.1f} audio s/s per worker: {summary['replayed_makespan']:.1f}s")
     print('Done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import os
+import queue
+import random
+import unittest
+from audio import probe_duration
+
+
+# Used when the container header has no duration, a typical compressed audio bitrate of 128 kbit/s
+fallback_bytes_per_second = 16000
+
+# Decoded 16 bit audio, float copies of segments and the pydub path's source rate samples, per second of audio
+default_bytes_per_audio_second = 256 * 1024
+
+# Worker memory that does not depend on the clip length (interpreter, torch, kernels)
+default_task_memory_overhead = 256 << 20
+
+# Seconds of audio a CPU worker aligns and segments per second, used to predict the makespan before dispatch
+# when there is no previous run to calibrate from
+default_audio_seconds_per_worker_second = 100.0
+
+
+def probe_durations(clip_files, max_threads=16):
+    # ffprobe only reads the headers, so probing is I/O bound and runs on threads. None where the duration is unknown
+    with ThreadPoolExecutor(max_threads) as executor:
+        return list(executor.map(probe_duration, clip_files))
+
+
+def estimate_duration(clip_file):
+    # From the file size alone, so it is the same on every node reading a shared corpus
+    return os.path.getsize(clip_file) / fallback_bytes_per_second
+
+
+def assign_shards(clip_files, durations, num_shards):
+    # Longest clip first to the shard with the least audio so far. Ties in duration are broken by a hash of the
+    # path and ties in shard totals by index, so the assignment does not depend on the order of clip_files. The
+    # durations must be computed the same way on every node, e.g. by estimate_duration rather than probed
+    order = sorted(range(len(clip_files)), key=lambda i: (-durations[i], hashlib.sha256(clip_files[i].encode()).hexdigest()))
+    shard_totals = [(0.0, shard_index) for shard_index in range(num_shards)]
+    shard_indices = [None] * len(clip_files)
+
+    for i in order:
+        total, shard_index = heapq.heappop(shard_totals)
+        shard_indices[i] = shard_index
+        heapq.heappush(shard_totals, (total + durations[i], shard_index))
+
+    return shard_indices
+
+
+class ClipTask:
+    def __init__(self, clip_file, duration, memory, probed_duration=None):
+        self.clip_file = clip_file
+        # The probed duration, or an estimate from the file size that only orders the tasks
+        self.duration = duration
+        self.memory = memory
+        self.probed_duration = probed_duration
+
+
+def create_tasks(clip_files, probed_durations, bytes_per_audio_second=default_bytes_per_audio_second, task_memory_overhead=default_task_memory_overhead):
+    # Longest first, so the longest clips never start last and leave the other workers idle
+    tasks = []
+    for clip_file, probed_duration in zip(clip_files, probed_durations):
+        if probed_duration is not None:
+            tasks.append(ClipTask(clip_file, probed_duration, task_memory_overhead + int(probed_duration * bytes_per_audio_second), probed_duration))
+        else:
+            # The size of a video container can be many times its audio, so only the fixed overhead of a clip
+            # without a probed duration counts against the memory budget
+            tasks.append(ClipTask(clip_file, estimate_duration(clip_file), task_memory_overhead))
+    tasks.sort(key=lambda task: -task.duration)
+    return tasks
+
+
+def can_dispatch(task, num_running, running_memory, num_workers, memory_budget):
+    if num_running >= num_workers:
+        return False
+    # A clip over the whole budget still runs, alone
+    if memory_budget is not None and num_running > 0 and running_memory + task.memory > memory_budget:
+        return False
+    return True
+
+
+def simulate_schedule(tasks, num_workers, memory_budget=None, audio_seconds_per_second=1.0):
+    # Makespan of dispatching the tasks in order with the same rules as ClipScheduler,
+    # given how many seconds of audio a worker processes per second
+    running = []
+    running_memory = 0
+    time_now = 0.0
+
+    for task in tasks:
+        while not can_dispatch(task, len(running), running_memory, num_workers, memory_budget):
+            time_now, memory = heapq.heappop(running)
+            running_memory -= memory
+
+        heapq.heappush(running, (time_now + task.duration / audio_seconds_per_second, task.memory))
+        running_memory += task.memory
+
+    return max([end_time for end_time, _ in running], default=time_now)
+
+
+class ClipScheduler:
+    # Dispatches tasks in order to a multiprocessing pool, keeping at most num_workers tasks and
+    # memory_budget bytes of estimated memory in flight, and yields results in completion order. function is
+    # called with the clip file and probed duration (None if unknown) of each task
+    def __init__(self, pool, function, num_workers, memory_budget=None):
+        self.pool = pool
+        self.function = function
+        self.num_workers = num_workers
+        self.memory_budget = memory_budget
+
+    def run(self, tasks):
+        completed = queue.Queue()
+        pending = list(reversed(tasks))
+        num_running = 0
+        running_memory = 0
+
+        while len(pending) > 0 or num_running > 0:
+            while len(pending) > 0 and can_dispatch(pending[-1], num_running, running_memory, self.num_workers, self.memory_budget):
+                task = pending.pop()
+                self.pool.apply_async(
+                    self.function, (task.clip_file, task.probed_duration),
+                    callback=lambda result, task=task: completed.put((task, result, None)),
+                    error_callback=lambda error, task=task: completed.put((task, None, error)),
+                )
+                num_running += 1
+                running_memory += task.memory
+
+            task, result, error = completed.get()
+            num_running -= 1
+            running_memory -= task.memory
+
+            if error is not None:
+                raise error
+
+            yield task, result
+
+
+class AssignShardsTest(unittest.TestCase):
+    def test_nodes_agree_and_shards_are_balanced(self):
+        rng = random.Random(0)
+        durations = {f'data/clip{i}/clip.m4a': rng.choice([60, 600, 1800, 5400, rng.uniform(10, 7200)]) for i in range(500)}
+        num_shards = 7
+
+        # Two nodes listing the corpus in different orders
+        assignments = []
+        for seed in [1, 2]:
+            clip_files = list(durations)
+            random.Random(seed).shuffle(clip_files)
+            shard_indices = assign_shards(clip_files, [durations[clip_file] for clip_file in clip_files], num_shards)
+            assignments.append(dict(zip(clip_files, shard_indices)))
+        self.assertEqual(assignments[0], assignments[1])
+
+        shard_totals = [0.0] * num_shards
+        for clip_file, shard_index in assignments[0].items():
+            shard_totals[shard_index] += durations[clip_file]
+        # Longest first greedy leaves the shards at most one clip apart
+        self.assertLessEqual(max(shard_totals) - min(shard_totals), max(durations.values()))
@@ -1,13 +1,13 @@
 from glob import glob
 import pysrt
-from utils import filter_sub_text
+from utils import filter_corpus_text
 from languages import languages
 from argparse import ArgumentParser
 from tqdm import tqdm
 
 
-def transform(t):
-    result = filter_sub_text(t, language)
+def transform(t, language, skip_blacklisted=False):
+    result = filter_corpus_text(t, language, skip_blacklisted=skip_blacklisted)
     return result
 
 
@@ -35,10 +35,12 @@ if __name__ == '__main__':
     parser.add_argument('--output', help='Output path for corpus to be written in', type=str)
     parser.add_argument('--input_dir', help='Input directory containing SRT files to collect', type=str)
     parser.add_argument('--input_type', help='Either SRT files or text files', choices=file_loaders.keys())
+    parser.add_argument('--skip-blacklisted', help="Skip texts containing the language's blacklisted phrases", action='store_true')
     args = parser.parse_args()
 
 
     language_code = args.language
+    language = languages[language_code]
     input_dir_path = args.input_dir
     output_path = args.output
     input_type = args.input_type
@@ -50,7 +52,7 @@ if __name__ == '__main__':
     text_lists = (file_loader(file_path) for file_path in file_paths)
     all_texts = (text for texts in text_lists for text in texts)
 
-    transformed_texts = (transform(t) for t in all_texts)
+    transformed_texts = (transform(t, language, skip_blacklisted=args.skip_blacklisted) for t in all_texts)
     filtered_texts = (t for t in transformed_texts if t is not None)
 
     with open(output_path, 'w') as f:
@@ -1,9 +1,24 @@
 import torch
 import pysrt
-import torchaudio
-import matplotlib.pyplot as plt
 from bisect import bisect_right
 import math
+import numpy
+import scipy.fft
+import unittest
+from functools import partial, lru_cache
+
+
+convolution_engines = ('direct', 'fft')
+# Above this kernel size FFT convolution beats direct convolution on CPU
+fft_min_kernel_size = 128
+# Kernel spectra kept per kernel, the full chunk size plus a few tail chunk sizes
+max_kernel_spectra = 4
+# Both passes convolve non negative values, so FFT outputs below this are round-off and zeroed, as direct
+# convolution gives for digital silence. Otherwise the noise decides where the minimum of a silence lands
+fft_noise_floor = 1e-9
+# A silence's minimum point is its first sample within this of its minimum. In digital silence the envelope is
+# flat up to float32 rounding, which differs between chunks and engines, so exact ties would land anywhere in it
+min_point_tolerance = 1e-9
 
 
 def create_gaussian_kernel(size, sigma):
@@ -24,67 +39,212 @@ def create_gaussian_kernel(size, sigma):
     return kernel
 
 
-def find_silence_points(waveform, sample_rate, device, threshold=0.020, kernel_size=8193, exp=6, bitdepth=16):
-    input = waveform
-    input = input.abs()
-    # input /= input.max()
-    input /= (1 << bitdepth) // 2 - 1
+@lru_cache(maxsize=None)
+def get_gaussian_kernel(kernel_size, device):
+    # Shared by every clip a process handles, device is a string so it can be a cache key
+    return create_gaussian_kernel(size=[kernel_size], sigma=[kernel_size // 4])[None, None, :].to(device)
 
-    clamped_input = input.clamp(max=threshold * 4)
-    del input
 
-    kernel = create_gaussian_kernel(size=[kernel_size], sigma=[kernel_size // 4])[None, None, :].to(device)
+@lru_cache(maxsize=None)
+def get_kernel_spectra(kernel_size):
+    return {}
 
-    conv = torch.nn.functional.conv1d(clamped_input, kernel, padding=kernel.numel() // 2)
 
-    conv = (conv + (1 - threshold)) ** exp - (1 - threshold) ** exp
-    conv = torch.nn.functional.conv1d(conv, kernel, padding=kernel.numel() // 2)
-    filter = (conv < threshold).long()
+def select_convolution_engine(kernel_size, device):
+    if torch.device(device).type == 'cuda' or kernel_size < fft_min_kernel_size:
+        return 'direct'
 
-    padding = torch.tensor([0], dtype=torch.long, device=device)
-    filter_positive = filter.squeeze() == 1
-    filter_negative = torch.cat([filter.squeeze()[1:], padding]) != 1
-    del filter
+    return 'fft'
 
-    falling_edges = (filter_positive & filter_negative).long()
-    falling_edges_indexes = (falling_edges == 1).nonzero().flatten().tolist()
-    del falling_edges
 
-    raising_edges = (~filter_positive & ~filter_negative).long()
-    raising_edges_indexes = (raising_edges == 1).nonzero().flatten().tolist()
-    del raising_edges
+def fft_conv1d(input, kernel, kernel_spectra):
+    # Same output as conv1d without padding, computed as a single overlap-save block. Double precision keeps
+    # the round-off (about 1e-17 here) far below fft_noise_floor, in single precision it is about 1e-7
+    signal = input[0, 0].cpu().numpy().astype(numpy.float64)
+    weights = kernel[0, 0].cpu().numpy().astype(numpy.float64)
 
-    del filter_positive, filter_negative
+    fft_size = scipy.fft.next_fast_len(signal.size, real=True)
+    if fft_size in kernel_spectra:
+        kernel_spectra[fft_size] = kernel_spectra.pop(fft_size)
+    else:
+        # Tail chunks of every clip have a different size, so only the most recently used spectra are kept
+        while len(kernel_spectra) >= max_kernel_spectra:
+            del kernel_spectra[next(iter(kernel_spectra))]
+        kernel_spectra[fft_size] = scipy.fft.rfft(weights[::-1], fft_size)
 
-    if (falling_edges_indexes + [float('inf')])[0] < (raising_edges_indexes + [float('inf')])[0]:
-        raising_edges_indexes.insert(0, 0)
+    spectrum = scipy.fft.rfft(signal, fft_size)
+    spectrum *= kernel_spectra[fft_size]
+    output = scipy.fft.irfft(spectrum, fft_size)[weights.size - 1:signal.size]
+    output[output < fft_noise_floor] = 0
 
-    if ([float('-inf')] + raising_edges_indexes)[-1] > ([float('-inf')] + falling_edges_indexes)[-1]:
-        falling_edges_indexes.append(-1)
+    return torch.from_numpy(output).to(device=input.device, dtype=input.dtype)[None, None, :]
 
-    # silence_mins = torch.zeros(conv.shape)
-    silence_edges = torch.zeros(conv.shape)
-    silence_min_points = []
-    silence_edge_points = []
-    for r, f in zip(raising_edges_indexes, falling_edges_indexes):
-        min_index = (r + conv[0, 0, r:f].argmin()).item()
-        # silence_mins[0, 0, min_index] = 1
-        silence_min_points.append(min_index)
 
-        silence_edges[0, 0, r] = 1
-        silence_edge_points.append(r)
-        silence_edges[0, 0, f] = 1
-        silence_edge_points.append(f)
+def smooth_silence_envelope(waveform, device, threshold=0.020, kernel_size=8193, exp=6, bitdepth=16, chunk_size=1 << 20, engine=None):
+    samples = waveform.flatten()
+    num_samples = samples.numel()
+    chunk_size = chunk_size or max(num_samples, 1)
+
+    kernel = get_gaussian_kernel(kernel_size, str(device))
+    radius = kernel.numel() // 2
+
+    engine = engine or select_convolution_engine(kernel_size, device)
+    if engine == 'fft':
+        conv1d = partial(fft_conv1d, kernel_spectra=get_kernel_spectra(kernel_size))
+    elif engine == 'direct':
+        conv1d = torch.nn.functional.conv1d
+    else:
+        raise ValueError(f'Unknown convolution engine: {engine}')
+
+    for start in range(0, num_samples, chunk_size):
+        end = min(start + chunk_size, num_samples)
+
+        # Each output sample depends on 2 * radius input samples on each side (two smoothing passes)
+        input_start = max(start - 2 * radius, 0)
+        input_end = min(end + 2 * radius, num_samples)
+
+        input = samples[input_start:input_end].to(device=device, dtype=torch.float32)
+        input = input.abs()
+        input /= (1 << bitdepth) // 2 - 1
+
+        clamped_input = input.clamp(max=threshold * 4)[None, None, :]
+        del input
+
+        clamped_input = torch.nn.functional.pad(clamped_input, [input_start - (start - 2 * radius), (end + 2 * radius) - input_end])
+
+        # Covers [start - radius, end + radius)
+        conv = conv1d(clamped_input, kernel)
+        del clamped_input
+
+        conv = (conv + (1 - threshold)) ** exp - (1 - threshold) ** exp
+
+        # The second pass is zero padded at the clip boundaries only
+        outside_start = max(radius - start, 0)
+        outside_end = max(end + radius - num_samples, 0)
+        if outside_start > 0:
+            conv[..., :outside_start] = 0
+        if outside_end > 0:
+            conv[..., conv.shape[-1] - outside_end:] = 0
+
+        # Covers [start, end)
+        conv = conv1d(conv, kernel)
+
+        yield start, conv[0, 0]
+
+
+def segment_argmin(values, starts, ends, tolerance=0):
+    # Minimum of values[start:end] for sorted, disjoint intervals, and the first index within tolerance of it
+    mins = numpy.full(len(starts), numpy.inf, dtype=values.dtype)
+    argmins = starts.copy()
+
+    non_empty = ends > starts
+    starts, ends = starts[non_empty], ends[non_empty]
+    if len(starts) == 0:
+        return mins, argmins
 
-    del silence_edges, conv
+    bounds = numpy.empty(2 * len(starts), dtype=numpy.int64)
+    bounds[0::2] = starts
+    bounds[1::2] = ends
+    # reduceat needs indexes inside the array, the last interval may end at its length
+    if bounds[-1] == len(values):
+        bounds = bounds[:-1]
+    segment_mins = numpy.minimum.reduceat(values, bounds)[0::2]
 
-    # torchaudio.save('/tmp/audio-conv.wav', (conv[0] << 31).cpu(), sample_rate)
-    # torchaudio.save('/tmp/audio-min-silence.wav', (silence_mins[0] * ((1 << 30) - 1)).cpu(), sample_rate)
-    # torchaudio.save('/tmp/audio-edges-silence.wav', (silence_edges[0] * ((1 << 30) - 1)).cpu(), sample_rate)
+    # Segment number of every value from the first interval on. Values between two intervals belong to
+    # the previous segment, they all come after its interval so they never precede its true argmin
+    span = values[starts[0]:ends[-1]]
+    markers = numpy.zeros(len(span), dtype=numpy.int32)
+    markers[starts - starts[0]] = 1
+    segment_ids = numpy.cumsum(markers, dtype=numpy.int32)
+    segment_ids -= 1
+
+    candidates = numpy.flatnonzero(span <= segment_mins[segment_ids] + tolerance)
+    _, first_candidates = numpy.unique(segment_ids[candidates], return_index=True)
+
+    mins[non_empty] = segment_mins
+    argmins[non_empty] = starts[0] + candidates[first_candidates]
+
+    return mins, argmins
+
+
+def find_silence_edges(envelope, num_samples, threshold=0.020):
+    silence_min_points = []
+    raising_edge_points = []
+    falling_edge_points = []
+
+    # Open silence carried between chunks: (raising edge, min value, min index, value at the min index)
+    open_silence = None
+    previous_value = None
+
+    for start, conv in envelope:
+        is_last_chunk = start + conv.numel() == num_samples
+        values = conv.cpu().numpy()
+
+        # Prepend the last sample of the previous chunk so edges on chunk boundaries are detected
+        if previous_value is not None:
+            values = numpy.concatenate([previous_value, values])
+            offset = start - 1
+        else:
+            offset = start
+
+        filter = values < threshold
+
+        if previous_value is None and filter[0]:
+            open_silence = (0, numpy.inf, 0, numpy.inf)
+
+        transitions = numpy.diff(filter.view(numpy.int8))
+        edges = numpy.flatnonzero(transitions)
+        raising_edges = edges[transitions[edges] == 1]
+        falling_edges = edges[transitions[edges] == -1]
+        if is_last_chunk and filter[-1]:
+            falling_edges = numpy.append(falling_edges, len(values) - 1)
+
+        # A silence still open from previous chunks starts (locally) at 0
+        starts = raising_edges
+        if open_silence is not None:
+            starts = numpy.concatenate([[0], raising_edges])
+
+        ends = numpy.append(falling_edges, len(values))
+        mins, argmins = segment_argmin(values, starts, ends[:len(starts)], tolerance=min_point_tolerance)
+        argmin_values = numpy.where(numpy.isinf(mins), numpy.inf, values[numpy.minimum(argmins, len(values) - 1)])
+        raising_edges = starts + offset
+        argmins += offset
+
+        # The earlier min point is kept while it is within tolerance of the minimum so far, as without chunks
+        if open_silence is not None:
+            open_start, open_min, open_argmin, open_argmin_value = open_silence
+            raising_edges[0] = open_start
+            if open_argmin_value <= mins[0] + min_point_tolerance:
+                argmins[0], argmin_values[0] = open_argmin, open_argmin_value
+            mins[0] = min(open_min, mins[0])
+
+        num_closed = len(falling_edges)
+        silence_min_points.append(argmins[:num_closed])
+        raising_edge_points.append(raising_edges[:num_closed])
+        falling_edge_points.append(falling_edges + offset)
+
+        open_silence = None
+        if len(starts) > num_closed:
+            open_silence = (raising_edges[-1], mins[-1], argmins[-1], argmin_values[-1])
+
+        previous_value = values[-1:]
+
+    silence_min_points = numpy.concatenate(silence_min_points or [numpy.empty(0, dtype=numpy.int64)])
+    raising_edge_points = numpy.concatenate(raising_edge_points or [numpy.empty(0, dtype=numpy.int64)])
+    falling_edge_points = numpy.concatenate(falling_edge_points or [numpy.empty(0, dtype=numpy.int64)])
+
+    silence_edge_points = numpy.empty(2 * len(raising_edge_points), dtype=numpy.int64)
+    silence_edge_points[0::2] = raising_edge_points
+    silence_edge_points[1::2] = falling_edge_points
 
     return silence_min_points, silence_edge_points
 
 
+def find_silence_points(waveform, sample_rate, device, threshold=0.020, kernel_size=8193, exp=6, bitdepth=16, chunk_size=1 << 20, engine=None):
+    envelope = smooth_silence_envelope(waveform, device, threshold=threshold, kernel_size=kernel_size, exp=exp, bitdepth=bitdepth, chunk_size=chunk_size, engine=engine)
+    return find_silence_edges(envelope, waveform.numel(), threshold=threshold)
+
+
 def find_nearest_silence(silence_times, position, window_ms_duration):
     left_index = bisect_right(silence_times, position) - 1
     left_point = silence_times[left_index] if 0 <= left_index < len(silence_times) else float('inf')
@@ -99,14 +259,39 @@ def find_nearest_silence(silence_times, position, window_ms_duration):
         return nearest_point
 
 
+def snap_to_nearest_silence(silence_times, positions, window_ms_duration):
+    # find_nearest_silence for a whole array of positions, silence_times must be sorted
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    silence_times = numpy.append(numpy.asarray(silence_times, dtype=numpy.float64), numpy.inf)
+
+    # Index -1 (no silence on the left) and len (none on the right) both land on the trailing inf
+    right_indexes = numpy.searchsorted(silence_times[:-1], positions, side='right')
+    left_points = silence_times[right_indexes - 1]
+    right_points = silence_times[right_indexes]
+
+    nearest_points = numpy.where(numpy.abs(positions - left_points) < numpy.abs(positions - right_points), left_points, right_points)
+    is_too_far = numpy.abs(positions - nearest_points) > window_ms_duration // 2
+
+    return numpy.where(is_too_far, positions, nearest_points).astype(numpy.int64)
+
+
+def align_times_by_silences(start_times, end_times, silence_edge_points, sample_rate, window_ms_duration=1000):
+    silence_times = numpy.round(numpy.asarray(silence_edge_points) / (sample_rate / 1000))
+
+    aligned_start_times = snap_to_nearest_silence(silence_times, start_times, window_ms_duration)
+    aligned_end_times = snap_to_nearest_silence(silence_times, end_times, window_ms_duration)
+
+    return aligned_start_times, aligned_end_times
+
+
 def align_subs_by_clip_silences(waveform, sample_rate, subs, device, window_ms_duration=1000):
     silence_min_points, silence_edges_points = find_silence_points(waveform, sample_rate, device)
-    silence_times = [round(x / (sample_rate / 1000)) for x in silence_edges_points]
 
-    for sub in subs:
-        aligned_start = find_nearest_silence(silence_times, sub.start.ordinal, window_ms_duration)
-        aligned_end = find_nearest_silence(silence_times, sub.end.ordinal, window_ms_duration)
+    start_times = [sub.start.ordinal for sub in subs]
+    end_times = [sub.end.ordinal for sub in subs]
+    aligned_start_times, aligned_end_times = align_times_by_silences(start_times, end_times, silence_edges_points, sample_rate, window_ms_duration)
 
+    for sub, aligned_start, aligned_end in zip(subs, aligned_start_times.tolist(), aligned_end_times.tolist()):
         sub.start.ordinal = aligned_start
         sub.end.ordinal = aligned_end
 
@@ -123,3 +308,84 @@ def create_sub_for_silence_points(silence_points, sample_rate, width=0.01):
 
     srt_file = pysrt.SubRipFile(items=items, eol='\n')
     return srt_file
+
+
+class SilenceDetectionTest(unittest.TestCase):
+    sample_rate = 16000
+    kernel_size = 257
+
+    def clip(self, *parts):
+        # Noise bursts for 'speech' and digital silence for 'silence', each part is (kind, seconds)
+        generator = torch.Generator().manual_seed(0)
+        samples = []
+        for kind, duration in parts:
+            num_samples = int(duration * self.sample_rate)
+            if kind == 'speech':
+                samples.append((torch.randn(num_samples, generator=generator) * 4000).round())
+            else:
+                samples.append(torch.zeros(num_samples))
+
+        return torch.cat(samples or [torch.zeros(0)])[None, None, :]
+
+    def find_silence_points(self, waveform, engine, chunk_size=None, kernel_size=None):
+        kernel_size = kernel_size or self.kernel_size
+        return find_silence_points(waveform, self.sample_rate, 'cpu', kernel_size=kernel_size, engine=engine, chunk_size=chunk_size)
+
+    def assert_points_equal(self, points, other_points):
+        for x, y in zip(points, other_points):
+            numpy.testing.assert_array_equal(x, y)
+
+    def test_chunked_matches_unchunked(self):
+        waveform = self.clip(('silence', 0.3), ('speech', 0.5), ('silence', 0.2), ('speech', 0.1), ('silence', 0.5), ('speech', 0.4))
+        # Chunks smaller than the kernel, around it and spanning several silences
+        for engine in convolution_engines:
+            expected = self.find_silence_points(waveform, engine)
+            for chunk_size in [100, self.kernel_size, 1000, 4096, 1 << 20]:
+                with self.subTest(engine=engine, chunk_size=chunk_size):
+                    self.assert_points_equal(self.find_silence_points(waveform, engine, chunk_size=chunk_size), expected)
+
+    def test_digital_silence_min_points_survive_chunking(self):
+        # The flat envelope of digital silence rounds differently in every chunk, chunks here are smaller than
+        # the kernel and the silences span several of them
+        waveform = self.clip(('speech', 0.3), ('silence', 0.8), ('speech', 0.2), ('silence', 1.2), ('speech', 0.3), ('silence', 0.6))
+        for engine in convolution_engines:
+            expected = self.find_silence_points(waveform, engine, kernel_size=2049)
+            for chunk_size in [1000, 5000]:
+                with self.subTest(engine=engine, chunk_size=chunk_size):
+                    self.assert_points_equal(self.find_silence_points(waveform, engine, chunk_size=chunk_size, kernel_size=2049), expected)
+
+    def test_engines_agree(self):
+        waveform = self.clip(('speech', 0.4), ('silence', 0.3), ('speech', 0.2), ('silence', 0.6), ('speech', 0.3))
+        direct_min_points, direct_edges = self.find_silence_points(waveform, 'direct', chunk_size=1000)
+        fft_min_points, fft_edges = self.find_silence_points(waveform, 'fft', chunk_size=1000)
+
+        self.assertEqual(len(direct_edges), 4)
+        numpy.testing.assert_array_equal(fft_edges, direct_edges)
+        numpy.testing.assert_allclose(fft_min_points, direct_min_points, atol=2)
+
+    def test_starts_and_ends_in_silence(self):
+        waveform = self.clip(('silence', 0.3), ('speech', 0.5), ('silence', 0.3))
+        for engine in convolution_engines:
+            with self.subTest(engine=engine):
+                min_points, edges = self.find_silence_points(waveform, engine, chunk_size=1000)
+                self.assertEqual(len(edges), 4)
+                self.assertEqual(edges[0], 0)
+                self.assertEqual(edges[-1], waveform.numel() - 1)
+                self.assertEqual(min_points[0], 0)
+
+    def test_fully_silent(self):
+        waveform = self.clip(('silence', 0.5))
+        for engine in convolution_engines:
+            for chunk_size in [100, None]:
+                with self.subTest(engine=engine, chunk_size=chunk_size):
+                    min_points, edges = self.find_silence_points(waveform, engine, chunk_size=chunk_size)
+                    numpy.testing.assert_array_equal(min_points, [0])
+                    numpy.testing.assert_array_equal(edges, [0, waveform.numel() - 1])
+
+    def test_empty(self):
+        waveform = self.clip()
+        for engine in convolution_engines:
+            with self.subTest(engine=engine):
+                min_points, edges = self.find_silence_points(waveform, engine)
+                self.assertEqual(len(min_points), 0)
+                self.assertEqual(len(edges), 0)
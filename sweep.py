@@ -0,0 +1,191 @@
+from argparse import ArgumentParser
+from contextlib import ExitStack
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import traceback
+import numpy
+from languages import languages
+from manifest import ManifestWriter
+from metrics import ClipMetrics, MetricsSummary
+from utils import normalize_sub_texts
+from prepare_manifest import (
+    ManifestConfig, load_clips_blacklist, find_clip_files, find_srt_file, get_clip_cache_key,
+    align_clip, segment_subtitles, write_clip_segments, init_worker, worker_state,
+)
+
+
+# Settings a sweep may vary, all of them only affect segment_subtitles
+sweep_parameters = ('merge_clips_threshold', 'max_merge_duration', 'max_word_count', 'segment_padding', 'audio_truncate')
+
+# Segment duration histogram bin edges in seconds, the last bin is open ended
+duration_histogram_bins = [0, 1, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 30]
+
+
+def load_sweep_grid(path):
+    # A YAML or JSON mapping of setting name to the list of values to try
+    import yaml
+
+    with open(path) as f:
+        grid = yaml.safe_load(f)
+
+    unknown_parameters = set(grid) - set(sweep_parameters)
+    if len(unknown_parameters) > 0:
+        raise ValueError(f'Cannot sweep {", ".join(sorted(unknown_parameters))}, only {", ".join(sweep_parameters)}')
+
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def create_sweep_configs(config, grid):
+    sweep_configs = []
+    for values in grid:
+        sweep_config = copy.deepcopy(config)
+        for name, value in values.items():
+            setattr(sweep_config, name, value)
+        sweep_configs.append(sweep_config)
+    return sweep_configs
+
+
+def init_sweep_worker(config, num_threads, sweep_configs, write_index):
+    init_worker(config, num_threads)
+    worker_state['sweep_configs'] = sweep_configs
+    worker_state['write_index'] = write_index
+
+
+def sweep_clip(clip_file):
+    # Decodes and aligns the clip once and segments it with every config. Returns the segment durations (ms)
+    # and word counts per config, and the manifest items of the config whose audio is written
+    config = worker_state['config']
+    sweep_configs = worker_state['sweep_configs']
+    write_index = worker_state['write_index']
+    metrics = ClipMetrics(clip_file)
+    clip_stats = None
+    clip_manifest_items = []
+
+    try:
+        clip_id = os.path.basename(os.path.dirname(clip_file))
+        srt_file = find_srt_file(clip_file, config)
+        if clip_id not in config.clips_blacklist and srt_file is not None:
+            clip_audio_tensor, sub_texts, sub_start_times, sub_end_times = align_clip(clip_file, srt_file, config, device=worker_state['device'], metrics=metrics)
+            clip_duration_ms = clip_audio_tensor.shape[-1] * 1000 // config.target_sample_rate
+            with metrics.stage('segmentation'):
+                sub_pieces = normalize_sub_texts(sub_texts, config.language)
+
+            clip_stats = []
+            for index, sweep_config in enumerate(sweep_configs):
+                with metrics.stage('segmentation'):
+                    segments = segment_subtitles(sub_texts, sub_start_times, sub_end_times, clip_duration_ms, sweep_config, sub_pieces=sub_pieces)
+
+                clip_stats.append((
+                    [segment['end_ms'] - segment['start_ms'] for segment in segments],
+                    [segment['text'].count(' ') + 1 for segment in segments],
+                ))
+
+                if index == write_index:
+                    cache_key = get_clip_cache_key(clip_file, srt_file, sweep_config)
+                    clip_manifest_items = write_clip_segments(clip_file, clip_audio_tensor, segments, sweep_config, cache_key, metrics=metrics)
+    except Exception:
+        traceback.print_exc()
+        metrics.set('error', True)
+
+    return clip_stats, clip_manifest_items, metrics.to_dict()
+
+
+class SweepStats:
+    def __init__(self, num_configs):
+        self.durations = [[] for _ in range(num_configs)]
+        self.word_counts = [[] for _ in range(num_configs)]
+
+    def add(self, clip_stats):
+        for index, (durations, word_counts) in enumerate(clip_stats):
+            self.durations[index].extend(durations)
+            self.word_counts[index].extend(word_counts)
+
+    def config_stats(self, index):
+        durations = numpy.array(self.durations[index], dtype=numpy.float64) / 1000
+        word_counts = numpy.array(self.word_counts[index], dtype=numpy.int64)
+        histogram, _ = numpy.histogram(durations, bins=duration_histogram_bins + [numpy.inf])
+
+        return {
+            'segments': len(durations),
+            'total_duration': float(durations.sum()),
+            'mean_duration': float(durations.mean()) if len(durations) > 0 else None,
+            'median_duration': float(numpy.median(durations)) if len(durations) > 0 else None,
+            'duration_histogram': {
+                f'{low}-{high}' if high != numpy.inf else f'{low}+': int(count)
+                for low, high, count in zip(duration_histogram_bins, duration_histogram_bins[1:] + [numpy.inf], histogram)
+            },
+            'words': int(word_counts.sum()),
+            'words_per_second': float(word_counts.sum() / durations.sum()) if durations.sum() > 0 else None,
+        }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('grid', help='YAML or JSON file mapping segmentation settings to lists of values, e.g. {"max_word_count": [30, 50]}', type=str)
+    parser.add_argument('--workers', help='Number of processes to run concurrently', type=int, default=1)
+    parser.add_argument('--language', help='Language of expected subtitles. Used for cleaning the outputs.', choices=languages.keys(), default='en')
+    parser.add_argument('--language_locales', help='Comma separated subtitle locales to look for', type=str, default=None)
+    parser.add_argument('--pcm-cache-size', help='MB of decoded audio and silence points to keep for later runs, disabled by default', type=int, default=None)
+    parser.add_argument('--write-config', help='Index of the grid config to write segment audio and manifests for', type=int, default=None)
+    parser.add_argument('--out-path', help="Directory of the sweep's outputs, kept apart from prepare_manifest's so a sweep never overwrites them", type=str, default='sweep')
+    args = parser.parse_args()
+
+    from tqdm import tqdm
+
+    config = ManifestConfig(
+        language_code=args.language,
+        out_path=args.out_path,
+        language_locales=None if args.language_locales is None else args.language_locales.split(','),
+        clips_blacklist=load_clips_blacklist(),
+        pcm_cache_size=args.pcm_cache_size << 20 if args.pcm_cache_size is not None else None,
+    )
+    grid = load_sweep_grid(args.grid)
+    if args.write_config is not None and args.write_config not in range(len(grid)):
+        parser.error(f'--write-config must be between 0 and {len(grid) - 1}, the grid has {len(grid)} configs')
+    sweep_configs = create_sweep_configs(config, grid)
+    threads_per_worker = max(os.cpu_count() // args.workers, 1)
+
+    os.makedirs(config.out_path, exist_ok=True)
+    os.makedirs(config.segments_path, exist_ok=True)
+    if config.pcm_cache_size is not None:
+        os.makedirs(config.pcm_cache_path, exist_ok=True)
+
+    clip_files = find_clip_files()
+    initargs = (config, threads_per_worker, sweep_configs, args.write_config)
+    if args.workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(args.workers, initializer=init_sweep_worker, initargs=initargs)
+        clip_results = pool.imap_unordered(sweep_clip, clip_files)
+    else:
+        init_sweep_worker(*initargs)
+        clip_results = map(sweep_clip, clip_files)
+
+    sweep_stats = SweepStats(len(sweep_configs))
+    metrics_summary = MetricsSummary()
+    with ExitStack() as stack:
+        manifest_writer = stack.enter_context(ManifestWriter(config.out_path)) if args.write_config is not None else None
+
+        for clip_stats, clip_manifest_items, clip_metrics in tqdm(clip_results, total=len(clip_files)):
+            if clip_stats is not None:
+                sweep_stats.add(clip_stats)
+            if manifest_writer is not None:
+                manifest_writer.write_clip(clip_manifest_items)
+            metrics_summary.add(clip_metrics)
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
+    sweep = [{'index': index, 'config': values, **sweep_stats.config_stats(index)} for index, values in enumerate(grid)]
+    with open(os.path.join(config.out_path, 'sweep.json'), 'w') as f:
+        json.dump({'configs': sweep, 'metrics': metrics_summary.to_dict()}, f, indent=True)
+
+    for result in sweep:
+        print(
+            f"{result['index']:3d} {json.dumps(result['config'])}: {result['segments']} segments, "
+            f"{result['total_duration'] / 3600:.2f}h, mean {result['mean_duration'] or 0:.1f}s, "
+            f"{result['words_per_second'] or 0:.2f} words/s"
+        )
+    print(metrics_summary.report())
@@ -1,9 +1,17 @@
 import re
+from collections import deque
 from contextlib import contextmanager
+import itertools
+import queue
 import sys
 import os
-import pysrt
 import codecs
+import tempfile
+import unittest
+
+
+# Bump whenever filter_sub_text or a Language.filter_text output changes, to invalidate cached clips
+normalizer_version = 1
 
 
 @contextmanager
@@ -18,6 +26,9 @@ def suppress_stdout():
 
 
 def srt_to_audacity_labels(srt_file_path, output_file_path):
+    # pysrt is imported here, so the scripts importing utils do not load it unless they read subtitles
+    import pysrt
+
     subs = pysrt.open(srt_file_path, encoding='utf-8')
 
     output = codecs.open(output_file_path, 'w', 'utf-8')
@@ -30,27 +41,286 @@ def srt_to_audacity_labels(srt_file_path, output_file_path):
     output.close()
 
 
+def imap_ordered(pool, function, items, max_pending):
+    # Like pool.imap, but items are only taken while fewer than max_pending results are waiting, so memory stays
+    # bounded when the items are read lazily. Results finishing early wait for the ones before them.
+    # Runs in this process when pool is None
+    if pool is None:
+        yield from map(function, items)
+        return
+
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def imap_unordered(pool, function, items, max_pending):
+    # Like pool.imap_unordered, with at most max_pending items taken and not yet yielded.
+    # Results are yielded in completion order. Runs in this process when pool is None
+    if pool is None:
+        yield from map(function, items)
+        return
+
+    completed = queue.Queue()
+    num_pending = 0
+    items = iter(items)
+    while True:
+        for item in itertools.islice(items, max_pending - num_pending):
+            pool.apply_async(
+                function, (item,),
+                callback=lambda result: completed.put((result, None)),
+                error_callback=lambda error: completed.put((None, error)),
+            )
+            num_pending += 1
+
+        if num_pending == 0:
+            return
+
+        result, error = completed.get()
+        num_pending -= 1
+
+        if error is not None:
+            raise error
+
+        yield result
+
+
+def batched(items, batch_size):
+    # Lists of batch_size consecutive items, the last may be shorter. Takes the items lazily
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def read_line_chunks(input_path, chunk_size, limit=None):
+    # Yields the input in chunks of about chunk_size bytes that end on a line break, \n, \r\n or \r, with the line
+    # breaks translated to \n like text mode reading does. With a limit only its first lines are yielded
+    lines_left = limit
+    with open(input_path, 'rb') as f:
+        # Reads since the last line break, joined once so a long line is not copied again on every read
+        pieces = []
+        while lines_left is None or lines_left > 0:
+            data = f.read(chunk_size)
+            if len(data) > 0:
+                # A \r ending the read may be the first half of a \r\n, it is left for the next chunk
+                search_end = len(data) - 1 if data.endswith(b'\r') else len(data)
+                end = max(data.rfind(b'\n', 0, search_end), data.rfind(b'\r', 0, search_end)) + 1
+                if end == 0:
+                    pieces.append(data)
+                    continue
+                pieces.append(data[:end])
+                chunk = b''.join(pieces)
+                pieces = [data[end:]]
+            else:
+                chunk = b''.join(pieces)
+                pieces = []
+                if len(chunk) == 0:
+                    break
+
+            num_bytes = len(chunk)
+            chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            if lines_left is not None:
+                num_lines = chunk.count(b'\n') + (not chunk.endswith(b'\n'))
+                if num_lines > lines_left:
+                    chunk = b'\n'.join(chunk.split(b'\n', lines_left)[:lines_left]) + b'\n'
+                lines_left -= min(num_lines, lines_left)
+
+            yield chunk, num_bytes
+
+
+def split_chunk_lines(chunk):
+    # Lines of a chunk from read_line_chunks, as bytes or decoded. The newline ending the chunk does not start
+    # another line
+    newline = b'\n' if isinstance(chunk, bytes) else '\n'
+    lines = chunk.split(newline)
+    if chunk.endswith(newline):
+        lines.pop()
+    return lines
+
+
+class TextNormalizer:
+    # filter_sub_text with its patterns compiled once. Each removal only runs when its opening character
+    # is in the text, which keeps the output identical to running all of them in order, and whitespace is
+    # collapsed once at the end unless the language filter depends on it
+    entity_regex = re.compile(r'&[^&\;]{2,8}\;')  # Reemove HTML entities
+    # With the character that ends the scan of each bracket's contents
+    bracket_regexes = [
+        ('(', ')', re.compile(r'\(' + r'[^\)]+' r'\)')),  # Remove text in parenthesis
+        ('[', ']', re.compile(r'\[' + r'[^\]]+' r'\]')),  # Remove text in brackets
+        ('{', '}', re.compile(r'\{' + r'[^\}]+' r'\}')),  # Remove text in curly brackets
+        ('<', '>', re.compile(r'\<' + r'[^\>]+' r'\}')),  # Remove text in triangular brackets
+    ]
+    whitespace_regex = re.compile(r'\s+')
+
+    def __init__(self, language):
+        self.language = language
+
+    def normalize(self, text):
+        return self.normalize_piece(text)[0]
+
+    def normalize_piece(self, text):
+        # Also returns whether text normalizes the same inside a space joined text, then normalizing the joined
+        # text gives the space joined normalizations of its non empty parts. Only a removal whose scan reaches
+        # the end of the text can match across the join, a scan from the last opening character does unless
+        # a character ending it follows
+
+        # Reject strings with an english letter in it
+        # match = re.search(r'[a-zA-Z]', str)
+        # if match is not None:
+        #     return None
+
+        result = text.lower()
+        is_self_contained = True
+        if '&' in result:
+            is_self_contained = result.rfind('&') < result.rfind(';')
+            result = self.entity_regex.sub('', result)
+        for opening_char, closing_char, bracket_regex in self.bracket_regexes:
+            if opening_char in result:
+                is_self_contained = is_self_contained and result.rfind(opening_char) < result.rfind(closing_char)
+                result = bracket_regex.sub('', result)
+        result = self.language.filter_text_keep_whitespace(result)
+        result = self.whitespace_regex.sub(' ', result)
+        result = result.strip()
+
+        if result == '':
+            return None, is_self_contained
+
+        return result, is_self_contained
+
+
+normalizers = {}
+
+
+def get_normalizer(language):
+    if language.name not in normalizers:
+        normalizers[language.name] = TextNormalizer(language)
+    return normalizers[language.name]
+
+
 def filter_sub_text(text, language):
-    result = text
-
-    # Reject strings with an english letter in it
-    # match = re.search(r'[a-zA-Z]', str)
-    # if match is not None:
-    #     return None
-
-    result = result.lower()
-    result = re.sub(r'&[^&\;]{2,8}\;', '', result)  # Reemove HTML entities
-    result = re.sub(r'\(' + r'[^\)]+' r'\)', '', result)  # Remove text in parenthesis
-    result = re.sub(r'\[' + r'[^\]]+' r'\]', '', result)  # Remove text in brackets
-    result = re.sub(r'\{' + r'[^\}]+' r'\}', '', result)  # Remove text in curly brackets
-    result = re.sub(r'\<' + r'[^\>]+' r'\}', '', result)  # Remove text in triangular brackets
-    result = re.sub(r'\s+', ' ', result)
-    result = language.filter_text(result)
-    result = re.sub(r'\s+', ' ', result)
-    result = result.strip()
-
-    if result == '':
+    return get_normalizer(language).normalize(text)
+
+
+def filter_corpus_text(text, language, skip_blacklisted=False):
+    # filter_sub_text for the corpus tools. With skip_blacklisted, blacklisted lines are dropped as prepare_manifest
+    # drops the subtitles
+    if skip_blacklisted and language.is_blacklisted(text):
         return None
+    return filter_sub_text(text, language)
+
+
+def normalize_sub_texts(sub_texts, language):
+    # (normalized text, is self contained) per subtitle
+    normalizer = get_normalizer(language)
+    return [normalizer.normalize_piece(sub_text) for sub_text in sub_texts]
+
+
+class ImapTest(unittest.TestCase):
+    def test_order_and_read_ahead(self):
+        import time
+        from multiprocessing.pool import ThreadPool
+
+        taken = []
+
+        def items():
+            for i in range(50):
+                taken.append(i)
+                yield i
+
+        def function(i):
+            time.sleep((i * 7 % 5) / 1000)
+            return i * i
+
+        with ThreadPool(4) as pool:
+            for i, result in enumerate(imap_ordered(pool, function, items(), max_pending=3)):
+                self.assertEqual(result, i * i)
+                self.assertLessEqual(len(taken), i + 3)
+
+        self.assertEqual(list(imap_ordered(None, function, range(5), max_pending=3)), [0, 1, 4, 9, 16])
+
+    def test_unordered_read_ahead(self):
+        from multiprocessing.pool import ThreadPool
+
+        taken = []
+
+        def items():
+            for i in range(50):
+                taken.append(i)
+                yield i
+
+        with ThreadPool(4) as pool:
+            results = []
+            for result in imap_unordered(pool, lambda i: i * i, items(), max_pending=3):
+                results.append(result)
+                self.assertLessEqual(len(taken), len(results) + 3)
+
+        self.assertEqual(sorted(results), [i * i for i in range(50)])
+
+
+class ReadLineChunksTest(unittest.TestCase):
+    def read_chunks(self, data, chunk_size, limit=None):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'input.txt')
+            with open(input_path, 'wb') as f:
+                f.write(data)
+            return list(read_line_chunks(input_path, chunk_size, limit=limit))
+
+    def test_matches_text_mode_lines(self):
+        data = b'ab\r\ncd\re\n\r\n\rfgh\r\r\nij\nk'
+        expected = data.decode().replace('\r\n', '\n').replace('\r', '\n').encode()
+        for chunk_size in range(1, len(data) + 2):
+            chunks = self.read_chunks(data, chunk_size)
+            self.assertEqual(b''.join(chunk for chunk, _ in chunks), expected, chunk_size)
+            self.assertEqual(sum(num_bytes for _, num_bytes in chunks), len(data))
+            self.assertTrue(all(chunk.endswith(b'\n') for chunk, _ in chunks[:-1]))
+
+            limited = self.read_chunks(data, chunk_size, limit=4)
+            self.assertEqual(b''.join(chunk for chunk, _ in limited), b'ab\ncd\ne\n\n', chunk_size)
+
+    def test_line_breaks_bound_the_chunks(self):
+        # Carriage return line breaks split the input as newlines do, a single line is one chunk
+        chunks = self.read_chunks(b'x' * 50 + b'\r' + b'y' * 50 + b'\r', 10)
+        self.assertEqual([chunk for chunk, _ in chunks], [b'x' * 50 + b'\n', b'y' * 50 + b'\n'])
+        self.assertEqual(self.read_chunks(b'z' * 1000, 10), [(b'z' * 1000, 1000)])
+
+
+class TextNormalizerTest(unittest.TestCase):
+    def setUp(self):
+        from languages import languages
+
+        self.languages = languages
+
+    def test_removals(self):
+        self.assertEqual(filter_sub_text('Hello &amp; (laughs) [music] World {x} <i}ok 21', self.languages['en']), 'hello world ok 21')
+        self.assertEqual(filter_sub_text('<i>(music)</i>', self.languages['en']), 'ii')
+        self.assertIsNone(filter_sub_text(' (laughs)\n', self.languages['en']))
+
+    def test_hebrew(self):
+        self.assertEqual(filter_sub_text('  - שלום (צוחק)  עולם 1,250.5₪ ו-17%\n', self.languages['iw']), 'שלומ עולמ אלפ מאתיימ חמישימ וחצי ושבע עשרה')
+        self.assertEqual(filter_sub_text('ךםןףץ\t3.5', self.languages['iw']), 'כמנפצ שלוש וחצי')
+
+    def test_self_contained_texts_join(self):
+        for language in self.languages.values():
+            texts = ['Hello (laughs)\n', 'ok 1,250.5 ...', ' [x] \t', 'world - 17%', '&amp; 3.5']
+            pieces = normalize_sub_texts(texts, language)
+            self.assertTrue(all(is_self_contained for _, is_self_contained in pieces))
+            self.assertEqual(filter_sub_text(' '.join(texts), language), ' '.join(piece for piece, _ in pieces if piece is not None))
 
-    return result
+        for text in ['(laughs', 'a) (b', '&am', '<i} ok <b']:
+            self.assertFalse(get_normalizer(self.languages['en']).normalize_piece(text)[1])
 
+    def test_whitespace_is_collapsed_like_filter_text(self):
+        for language in self.languages.values():
+            text = 'a\tb \u00a0 3.5\n\nג'
+            self.assertEqual(
+                language.filter_text_keep_whitespace(text).split(),
+                language.filter_text(re.sub(r'\s+', ' ', text)).split(),
+            )